@@ -327,11 +327,11 @@ class Builder(object):
     def rsync(self, *args, **kwargs):
         args = flatten_string_list(args)
         self._check_call(["rsync"] + args, **kwargs)
-    def _dependency_collection(self, env):
+    def _dependency_collection(self, env, resolved=False, names=None):
         return read_json_dependencies_from_filename(
                 os.path.join('projectdata', 'dependencies.json'),
                 os.path.join('..', 'dependency_overrides.json'),
-                env, logfile=sys.stdout)
+                env, logfile=sys.stdout, resolved=resolved, names=names)
     def _process_dependency_args(self, *selected, **kwargs):
         kwargs = process_kwargs(
             "fetch_dependencies",
@@ -348,13 +348,16 @@ class Builder(object):
             env['linn-git-user'] = getpass.getuser()
         return selected, env
     def fetch_dependencies(self, *selected, **kwargs):
+        jobs = kwargs.pop('jobs', 1)
+        force = kwargs.pop('force', False)
+        report = kwargs.pop('report', None)
         selected, env = self._process_dependency_args(*selected, **kwargs)
         use_nuget = os.path.isfile('projectdata/packages.config')
         try:
             dependencies.fetch_dependencies(
                     selected or None, platform=self._context.env["OH_PLATFORM"], env=env,
                     fetch=True, nuget=use_nuget, clean=True, source=False, logfile=sys.stdout,
-                    local_overrides=not self._context.options.no_overrides)
+                    local_overrides=not self._context.options.no_overrides, jobs=jobs, force=force, report=report)
         except Exception as e:
             print e
             raise AbortRunException()
@@ -362,12 +365,13 @@ class Builder(object):
         selected, env = self._process_dependency_args(*selected, **kwargs)
         return self._dependency_collection(env)
     def fetch_source(self, *selected, **kwargs):
+        jobs = kwargs.pop('jobs', 1)
         selected, env = self._process_dependency_args(*selected, **kwargs)
         dependency_collection = self._dependency_collection(env)
-        return dependency_collection.checkout(selected or None)
+        return dependency_collection.checkout(selected or None, jobs=jobs)
     def get_dependency_args(self, *selected, **kwargs):
         selected, env = self._process_dependency_args(*selected, **kwargs)
-        dependency_collection = self._dependency_collection(env)
+        dependency_collection = self._dependency_collection(env, resolved=True, names=selected or None)
         return dependency_collection.get_args(selected or None)
 
 
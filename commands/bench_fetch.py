@@ -0,0 +1,396 @@
+import sys
+import os
+import json
+import hashlib
+import stat
+import cStringIO
+import time
+import random
+import shutil
+import tarfile
+import zipfile
+import tempfile
+import threading
+import subprocess
+import BaseHTTPServer
+import SocketServer
+from optparse import OptionParser, SUPPRESS_HELP
+import dependencies
+from dependencies import format_size
+
+description = "Benchmark fetching dependencies from a local stand-in server."
+command_group = "Developer tools"
+command_name = "bench-fetch"
+usage = """
+usage: %prog [options]
+
+Generates synthetic archives, serves them from an in-process HTTP server
+with simulated latency and bandwidth, and fetches them as dependencies
+into a scratch workspace, reporting timings for each scenario:
+
+  cold     Nothing cached: every archive is downloaded and unpacked.
+  warm     Every archive is in the download cache and is revalidated with
+           the server, then unpacked (or linked, with --store).
+  mixed    Half the archives are new versions, and half are still cached.
+  backends Everything cached, unpacked once by zipfile and tarfile and once
+           by the system's unzip and tar, checking that both produce the
+           same trees. See 'extract-backend' in dependencies.py.
+
+Each scenario's fetch runs in a child process, so that its peak resident
+set size (where the OS reports it) is the fetch's own.
+
+The data directory is moved into the scratch directory for the run, so
+the real download cache, store and config.json are neither used nor
+modified. Settings can still be given as OHDEVTOOLS_<KEY> environment
+variables.
+""".strip()
+
+class ArchiveServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''
+    Serves the files in a directory, with ETags so that clients can
+    revalidate cached copies. Each response is delayed by latency seconds
+    and each connection limited to bandwidth bytes per second, if set.
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+    def __init__(self, directory, latency=0, bandwidth=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), ArchiveRequestHandler)
+        self.directory = directory
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.bytes_sent = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}'.format(self.server_address[1])
+
+class ArchiveRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    def log_message(self, format, *args):
+        pass
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        if server.latency:
+            time.sleep(server.latency)
+        path = os.path.join(server.directory, os.path.basename(self.path.split('?')[0]))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        etag = '"{0}-{1}"'.format(int(os.path.getmtime(path)), size)
+        if self.headers.getheader('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        chunk_size = 64 * 1024
+        started = time.time()
+        sent = 0
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), ''):
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                if server.bandwidth:
+                    delay = started + float(sent) / server.bandwidth - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+        with server.lock:
+            server.bytes_sent += sent
+
+NOISE_SIZE = 256 * 1024
+TEXT = 'namespace OpenHome.Bench { class Generated { } }\n'
+
+def make_content(rng, noise, size):
+    # Half random bytes, which don't compress, and half repetitive text,
+    # which does, roughly like a mix of binaries and sources.
+    random_size = size // 2
+    random_part = ''
+    while len(random_part) < random_size:
+        offset = rng.randint(0, len(noise) - 1)
+        random_part += noise[offset:offset + random_size - len(random_part)]
+    return random_part + (TEXT * (size // len(TEXT) + 1))[:size - random_size]
+
+def archive_members(rng, noise, files, size, depth):
+    for i in xrange(files):
+        directories = ['dir{0}'.format(rng.randint(0, 3)) for _ in xrange(rng.randint(0, depth))]
+        yield '/'.join(['top'] + directories + ['file{0}.dat'.format(i)]), make_content(rng, noise, size)
+
+def make_archive(path, archive_format, rng, noise, files, size, depth):
+    members = archive_members(rng, noise, files, size, depth)
+    if archive_format == 'tar.gz':
+        with tarfile.open(path, 'w:gz') as tf:
+            for name, content in members:
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                info.mtime = time.time()
+                tf.addfile(info, cStringIO.StringIO(content))
+    else:
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for name, content in members:
+                zf.writestr(name, content)
+
+def snapshot_tree(root):
+    '''
+    Returns a dictionary describing every file, symlink and directory
+    under root, apart from manifests, to compare trees with.
+    '''
+    tree = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if d != dependencies.MANIFEST_DIRNAME]
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            relpath = os.path.relpath(path, root).replace(os.path.sep, '/')
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                tree[relpath] = ('link', os.readlink(path))
+            elif stat.S_ISDIR(st.st_mode):
+                tree[relpath] = ('dir',)
+            else:
+                with open(path, 'rb') as f:
+                    tree[relpath] = ('file', stat.S_IMODE(st.st_mode), hashlib.sha1(f.read()).hexdigest())
+    return tree
+
+def fetch_child(spec_path):
+    '''
+    Fetch the archives described by the JSON file at spec_path, and write
+    the outcome to the file it names. Runs in the child process started by
+    FetchBenchmark.fetch_in_child.
+    '''
+    with open(spec_path) as f:
+        spec = json.load(f)
+    fetcher = dependencies.FileFetcher(dependencies.FileCache(spec['cache'], dependencies.parse_size('100G')))
+    log = open(os.devnull, 'w') if not spec['verbose'] else sys.stdout
+    # The store, if any, is the one in the scratch data directory.
+    collection = dependencies.DependencyCollection({'platform': 'AnyPlatform'}, logfile=log, fetcher=fetcher)
+    for index, url in enumerate(spec['urls']):
+        collection.create_dependency({
+            'name': 'bench{0}'.format(index),
+            'archive-path': url,
+            'dest': 'dependencies/bench{0}/'.format(index),
+            'strip-archive-dirs': 1,
+            })
+    os.chdir(spec['workspace'])
+    started = time.time()
+    ok = collection.fetch(jobs=spec['jobs'])
+    seconds = time.time() - started
+    dependencies.write_fetch_report(spec['result'], {'ok': ok, 'seconds': seconds, 'dependencies': collection.report['dependencies']})
+
+class FetchBenchmark(object):
+    def __init__(self, root, options):
+        self.root = root
+        self.options = options
+        self.served = os.path.join(root, 'served')
+        self.workspace = os.path.join(root, 'workspace')
+        self.data = os.path.join(root, 'data')
+        os.makedirs(self.served)
+        os.makedirs(self.workspace)
+        os.makedirs(self.data)
+        with open(os.path.join(self.data, 'config.json'), 'w') as f:
+            json.dump({'shared-store': options.store}, f)
+        self.rng = random.Random(options.seed)
+        self.noise = ''.join(chr(self.rng.getrandbits(8)) for _ in xrange(NOISE_SIZE))
+        self.version = 0
+        self.names = []
+        self.server = ArchiveServer(self.served, options.latency / 1000.0,
+                dependencies.parse_size(options.bandwidth) if options.bandwidth else None)
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+    def filename(self, index):
+        archive_format = self.options.formats[index % len(self.options.formats)]
+        return 'bench{0}-v{1}.{2}'.format(index, self.versions[index], archive_format)
+    def generate(self):
+        self.versions = [0] * self.options.archives
+        for index in xrange(self.options.archives):
+            self.generate_one(index)
+    def generate_one(self, index):
+        options = self.options
+        make_archive(os.path.join(self.served, self.filename(index)), self.filename(index).split('.', 1)[1],
+                self.rng, self.noise, options.files, dependencies.parse_size(options.file_size), options.depth)
+    def new_version(self, index):
+        os.remove(os.path.join(self.served, self.filename(index)))
+        self.versions[index] += 1
+        self.generate_one(index)
+    def reset(self, cache=False, store=False):
+        paths = [os.path.join(self.workspace, 'dependencies')]
+        if cache:
+            paths.append(os.path.join(self.data, 'cache'))
+        if store:
+            paths.append(os.path.join(self.data, 'store'))
+        for path in paths:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+    def fetch_in_child(self):
+        '''
+        Fetch every archive in a fresh interpreter, so that its peak RSS
+        leaves out generating the archives and serving them. Returns what
+        fetch_child wrote, and the peak RSS in bytes, or None where the OS
+        doesn't report it.
+        '''
+        spec_path = os.path.join(self.root, 'child.json')
+        result_path = os.path.join(self.root, 'result.json')
+        with open(spec_path, 'w') as f:
+            json.dump({
+                'urls': ['{0}/{1}'.format(self.server.url, self.filename(index)) for index in xrange(self.options.archives)],
+                'cache': os.path.join(self.data, 'cache'),
+                'workspace': self.workspace,
+                'jobs': self.options.jobs,
+                'verbose': self.options.verbose,
+                'result': result_path,
+                }, f)
+        child = subprocess.Popen([sys.executable, '-m', 'commands.bench_fetch', '--child', spec_path])
+        maxrss = None
+        if hasattr(os, 'wait4'):
+            # The child's own rusage, including e.g. the native tar it runs.
+            pid, status, rusage = os.wait4(child.pid, 0)
+            child.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+            # Linux reports kilobytes, Mac OS bytes.
+            maxrss = rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss * 1024
+        else:
+            child.wait()
+        if child.returncode != 0:
+            raise Exception('Fetching in a child process failed.')
+        with open(result_path) as f:
+            return json.load(f), maxrss
+    def run(self, scenario):
+        bytes_sent = self.server.bytes_sent
+        requests = self.server.requests
+        fetched, maxrss = self.fetch_in_child()
+        ok = fetched['ok']
+        seconds = fetched['seconds']
+        reports = fetched['dependencies']
+        archive_bytes = sum(r['bytes'] for r in reports)
+        outcomes = {}
+        for r in reports:
+            outcomes[r['outcome']] = outcomes.get(r['outcome'], 0) + 1
+        return {
+            'scenario': scenario,
+            'ok': ok,
+            'seconds': seconds,
+            'requests': self.server.requests - requests,
+            'bytes-served': self.server.bytes_sent - bytes_sent,
+            'archive-bytes': archive_bytes,
+            'throughput': archive_bytes / seconds if seconds else None,
+            'time-to-first-byte': sum(r['time-to-first-byte'] or 0 for r in reports),
+            'download-seconds': sum(r['download-seconds'] or 0 for r in reports),
+            'extract-seconds': sum(r['extract-seconds'] or 0 for r in reports),
+            'files': sum(r['files'] or 0 for r in reports),
+            'outcomes': outcomes,
+            'peak-rss': maxrss,
+            'dependencies': reports,
+            }
+    def scenario_cold(self):
+        self.reset(cache=True, store=True)
+        return self.run('cold')
+    def scenario_warm(self):
+        self.reset(cache=False, store=False)
+        self.run('prime')
+        self.reset()
+        return self.run('warm')
+    def scenario_backends(self):
+        self.reset(cache=False, store=True)
+        self.run('prime')
+        results = []
+        trees = []
+        for backend in ['python', 'native']:
+            self.reset(store=True)
+            os.environ['OHDEVTOOLS_EXTRACT_BACKEND'] = backend
+            try:
+                results.append(self.run(backend))
+            finally:
+                del os.environ['OHDEVTOOLS_EXTRACT_BACKEND']
+            trees.append(snapshot_tree(os.path.join(self.workspace, 'dependencies')))
+        differences = sorted(relpath for relpath in set(trees[0]) | set(trees[1]) if trees[0].get(relpath) != trees[1].get(relpath))
+        for result in results:
+            result['differences'] = differences
+        return results
+    def scenario_mixed(self):
+        self.reset(cache=False, store=False)
+        self.run('prime')
+        self.reset()
+        for index in xrange(0, self.options.archives, 2):
+            self.new_version(index)
+        return self.run('mixed')
+
+SCENARIOS = ['cold', 'warm', 'mixed', 'backends']
+
+def print_results(results):
+    print "{0:<8} {1:>8} {2:>10} {3:>11} {4:>8} {5:>8} {6:>8} {7:>9}  {8}".format(
+            'scenario', 'seconds', 'archives', 'throughput', 'ttfb', 'download', 'extract', 'peak-rss', 'outcomes')
+    for r in results:
+        print "{0:<8} {1:>8.2f} {2:>10} {3:>11} {4:>8.2f} {5:>8.2f} {6:>8.2f} {7:>9}  {8}".format(
+                r['scenario'], r['seconds'], format_size(r['archive-bytes']),
+                format_size(r['throughput']) + '/s' if r['throughput'] else '-',
+                r['time-to-first-byte'], r['download-seconds'], r['extract-seconds'],
+                format_size(r['peak-rss']) if r['peak-rss'] else '-',
+                ', '.join('{0} {1}'.format(count, outcome) for (outcome, count) in sorted(r['outcomes'].items())))
+    print "Phase times are summed over dependencies, so overlap when fetching in parallel."
+    print "Peak RSS is of the child process that fetched, for each scenario."
+    compared = [r for r in results if 'differences' in r]
+    if compared:
+        differences = compared[0]['differences']
+        if differences:
+            print "The python and native backends produced different trees, e.g.:"
+            for relpath in differences[:10]:
+                print "  " + relpath
+        else:
+            print "The python and native backends produced identical trees."
+
+def main():
+    parser = OptionParser(usage=usage)
+    parser.add_option('--archives', type="int", default=8, help="Number of archives.")
+    parser.add_option('--files', type="int", default=200, help="Number of files in each archive.")
+    parser.add_option('--file-size', default='16K', help="Size of each file, e.g. '4K' or '1M'.")
+    parser.add_option('--depth', type="int", default=3, help="Maximum directory depth within archives.")
+    parser.add_option('--formats', default='tar.gz,zip,nupkg', help="Comma separated archive formats to cycle through.")
+    parser.add_option('--latency', type="float", default=20, help="Delay before each response, in milliseconds.")
+    parser.add_option('--bandwidth', default=None, help="Bytes per second per connection, e.g. '10M'. Unlimited by default.")
+    parser.add_option('-j', '--jobs', type="int", default=1, help="Number of dependencies to fetch at once.")
+    parser.add_option('--store', action="store_true", default=False, help="Use a shared store of unpacked trees.")
+    parser.add_option('--scenarios', default=','.join(SCENARIOS), help="Comma separated scenarios to run.")
+    parser.add_option('--seed', type="int", default=1, help="Seed for generating archive contents.")
+    parser.add_option('--report', default=None, metavar='PATH', help="Write the results as JSON to PATH.")
+    parser.add_option('--keep', action="store_true", default=False, help="Keep the scratch directory.")
+    parser.add_option('-v', '--verbose', action="store_true", default=False, help="Show the fetch log.")
+    parser.add_option('--child', default=None, help=SUPPRESS_HELP)
+    options, args = parser.parse_args()
+    if options.child is not None:
+        fetch_child(options.child)
+        return
+    options.formats = options.formats.split(',')
+    scenarios = options.scenarios.split(',')
+    unknown = [s for s in scenarios if s not in SCENARIOS]
+    if args or unknown:
+        parser.print_usage()
+        sys.exit(1)
+    root = tempfile.mkdtemp(prefix='bench-fetch-')
+    benchmark = FetchBenchmark(root, options)
+    os.environ['OHDEVTOOLS_DATA_DIR'] = benchmark.data
+    try:
+        print "Generating {0} archives in '{1}'...".format(options.archives, root)
+        benchmark.generate()
+        results = []
+        for scenario in scenarios:
+            result = getattr(benchmark, 'scenario_' + scenario)()
+            results.extend(result if isinstance(result, list) else [result])
+        print_results(results)
+        if options.report is not None:
+            dependencies.write_fetch_report(options.report, {'options': options.__dict__, 'results': results})
+    finally:
+        benchmark.close()
+        if not options.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
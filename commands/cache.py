@@ -0,0 +1,54 @@
+import sys
+from optparse import OptionParser
+import dependencies
+from dependencies import format_size
+
+description = "Report on and maintain the local download cache."
+command_group = "Developer tools"
+command_name = "cache"
+usage = """
+usage: %prog stats|prune|verify [options]
+
+  stats    Show the size of the cache, hit ratio and bytes saved.
+  prune    Evict least recently used entries until the cache fits its budget.
+  verify   Check the cache index against the files on disk and repair it.
+
+The budget is set by 'cache-size' in config.json in the data directory, or by
+the OHDEVTOOLS_CACHE_SIZE environment variable, e.g. '500M' or '4G'.
+""".strip()
+
+def main():
+    parser = OptionParser(usage=usage)
+    parser.add_option('--max-size', default=None, help="For prune, evict down to this size instead of the configured budget.")
+    parser.add_option('--all', action="store_true", default=False, help="For prune, empty the cache completely.")
+    options, args = parser.parse_args()
+    if len(args) != 1 or args[0] not in ['stats', 'prune', 'verify']:
+        parser.print_usage()
+        sys.exit(1)
+    cache = dependencies.make_default_cache()
+    if args[0] == 'stats':
+        stats = cache.stats()
+        print "Cache directory:  {0}".format(cache.path)
+        print "Entries:          {0}".format(stats['entries'])
+        print "Size:             {0} of {1}".format(format_size(stats['bytes']), format_size(stats['max_bytes']))
+        print "Hits:             {0}".format(stats['hits'])
+        print "Misses:           {0}".format(stats['misses'])
+        print "Hit ratio:        {0:.1%}".format(stats['hit_ratio'])
+        print "Bytes saved:      {0}".format(format_size(stats['bytes_saved']))
+    elif args[0] == 'prune':
+        if options.all:
+            max_bytes = 0
+        elif options.max_size is not None:
+            max_bytes = dependencies.parse_size(options.max_size)
+        else:
+            max_bytes = None
+        evicted = cache.clean(max_bytes)
+        print "Evicted {0} entries. Cache is now {1}.".format(evicted, format_size(cache.stats()['bytes']))
+    else:
+        problems = cache.verify()
+        for problem in problems:
+            print problem
+        print "{0} problems found and repaired.".format(len(problems))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import sys
+import os
+import re
+import shutil
+import socket
+import urllib2
+import urlparse
+import httplib
+import BaseHTTPServer
+import SocketServer
+from optparse import OptionParser
+import dependencies
+
+description = "Run a caching HTTP server for dependency downloads."
+command_group = "Developer tools"
+command_name = "cache-server"
+usage = """
+usage: %prog [options]
+
+Serves dependency archives to other machines from a download cache,
+fetching each one from its origin the first time it is asked for, so that
+a build farm downloads each new artifact once instead of once per agent.
+Concurrent requests for the same archive share one download. Cached
+copies are revalidated with the origin on every request, which costs a
+round trip but no body.
+
+Clients are pointed at it by setting 'upstream-cache' in config.json in
+their data directory, or the OHDEVTOOLS_UPSTREAM_CACHE environment
+variable, e.g. 'http://buildcache:8642'. They fall back to the origin if
+it can't be reached.
+
+Archives are requested as /fetch?url=<origin url>. Only http and https
+URLs under the binary repositories and mirrors of the dependency types,
+or under --allow prefixes, are fetched, so that the server can't be used
+to reach anything else.
+""".strip()
+
+DEFAULT_PORT = 8642
+
+def default_allowed_prefixes():
+    prefixes = set()
+    for defaults in dependencies.DEPENDENCY_TYPES.values():
+        for url in [defaults.get('binary-repo')] + list(defaults.get('binary-mirrors') or []):
+            if url:
+                # Not just any path that starts the same way.
+                prefixes.add(url.rstrip('/') + '/')
+    return sorted(prefixes)
+
+class CacheServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    def __init__(self, address, fetcher, allowed_prefixes=None, logfile=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, CacheRequestHandler)
+        self.fetcher = fetcher
+        self.allowed_prefixes = allowed_prefixes if allowed_prefixes is not None else default_allowed_prefixes()
+        self.logfile = dependencies.default_log(logfile)
+    def allowed(self, url):
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in ['http', 'https'] or '..' in parts.path.split('/'):
+            return False
+        return any(url.startswith(prefix) for prefix in self.allowed_prefixes)
+
+class CacheRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    def log_message(self, format, *args):
+        pass
+    def log(self, url, outcome, size=None):
+        line = "{0} {1} {2} {3}".format(self.client_address[0], outcome, '-' if size is None else dependencies.format_size(size), url)
+        self.server.logfile.write(line + "\n")
+        self.server.logfile.flush()
+    def do_GET(self):
+        parts = urlparse.urlsplit(self.path)
+        url = urlparse.parse_qs(parts.query).get('url', [None])[0]
+        if parts.path != '/fetch' or url is None:
+            self.send_error(404)
+            return
+        if not self.server.allowed(url):
+            self.log(url, 'refused')
+            self.send_error(403)
+            return
+        try:
+            f, method = self.server.fetcher.fetch(url, allow_cached=True)
+        except urllib2.HTTPError as e:
+            # Pass on what the origin said, but not its server errors, which
+            # would look like ours.
+            self.log(url, 'error {0}'.format(e.code))
+            self.send_error(e.code if e.code < 500 else 502)
+            return
+        except (IOError, socket.error, httplib.HTTPException) as e:
+            self.log(url, 'failed: {0}'.format(e))
+            self.send_error(502)
+            return
+        try:
+            self.send_content(url, f, method)
+        except socket.error:
+            # The client went away.
+            self.close_connection = 1
+        finally:
+            f.close()
+    def send_content(self, url, f, method):
+        validators = self.server.fetcher.cache.get_validators(url) or {}
+        etag = validators.get('etag')
+        last_modified = validators.get('last-modified')
+        size = os.fstat(f.fileno()).st_size
+        if_none_match = self.headers.getheader('If-None-Match')
+        if_modified_since = self.headers.getheader('If-Modified-Since')
+        if (etag is not None and if_none_match == etag) or (if_none_match is None and last_modified is not None and if_modified_since == last_modified):
+            self.log(url, method + ', not modified')
+            self.send_response(304)
+            self.send_validators(etag, last_modified)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        offset = 0
+        match = re.match(r'bytes=(\d+)-$', self.headers.getheader('Range') or '')
+        if_range = self.headers.getheader('If-Range')
+        if match and (if_range is None or if_range in [etag, last_modified]):
+            offset = int(match.group(1))
+            if offset >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{0}'.format(size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+        self.log(url, method, size - offset)
+        if offset > 0:
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(offset, size - 1, size))
+        else:
+            self.send_response(200)
+        self.send_validators(etag, last_modified)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(size - offset))
+        self.end_headers()
+        f.seek(offset)
+        shutil.copyfileobj(f, self.wfile, dependencies.COPY_BUFFER_SIZE)
+    def send_validators(self, etag, last_modified):
+        if etag is not None:
+            self.send_header('ETag', etag)
+        if last_modified is not None:
+            self.send_header('Last-Modified', last_modified)
+
+def main():
+    parser = OptionParser(usage=usage)
+    parser.add_option('--bind', default='', help="Address to listen on. All interfaces by default.")
+    parser.add_option('-p', '--port', type="int", default=DEFAULT_PORT, help="Port to listen on. Default {0}.".format(DEFAULT_PORT))
+    parser.add_option('--cache-dir', default=None, help="Directory for the cache, instead of the download cache in the data directory.")
+    parser.add_option('--max-size', default=None, help="Cache budget, e.g. '50G', instead of the configured 'cache-size'.")
+    parser.add_option('--allow', action="append", default=[], metavar='PREFIX', help="Also fetch URLs starting with PREFIX. May be given more than once.")
+    parser.add_option('--connections', type="int", default=8, help="Idle connections to keep open to each origin.")
+    options, args = parser.parse_args()
+    if args:
+        parser.print_usage()
+        sys.exit(1)
+    if options.cache_dir is None and options.max_size is None:
+        cache = dependencies.make_default_cache()
+    else:
+        cache = dependencies.FileCache(
+                options.cache_dir or dependencies.get_data_dir() + '/cache',
+                dependencies.parse_size(options.max_size or dependencies.get_config('cache-size', dependencies.DEFAULT_CACHE_SIZE)))
+    # Not make_default_fetcher, which could point us at ourselves.
+    fetcher = dependencies.FileFetcher(cache)
+    fetcher.set_concurrency(options.connections)
+    allowed_prefixes = default_allowed_prefixes() + options.allow
+    server = CacheServer((options.bind, options.port), fetcher, allowed_prefixes, sys.stdout)
+    print "Serving '{0}' on port {1}, for URLs under:".format(cache.path, server.server_address[1])
+    for prefix in allowed_prefixes:
+        print "  " + prefix
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
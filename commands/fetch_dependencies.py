@@ -31,6 +31,11 @@ A typical overrides file might look like this:
     }
 ]
 
+Setting 'shared-store' to true in config.json in the data directory
+(~/.ohdevtools, or %LOCALAPPDATA%/ohDevTools on Windows) shares unpacked
+dependencies between workspaces. Files under dependencies/ are then hard
+links into the store, and read-only, so patch them in a copy instead.
+
 See 'ohDevTools/dependencies.py' for details.
 
 """.strip()
@@ -48,8 +53,12 @@ def main():
     parser.add_option('--platform', default=None, help='Target platform.')
     parser.add_option('-l', '--list', action="store_true", default=False, help="Don't fetch anything, just list all dependencies.")
     parser.add_option('--no-overrides', action="store_true", default=False, help="Don't process ../dependency_overrides.json for local overrides.")
+    parser.add_option('--force', action="store_true", default=False, help="Fetch dependencies even if they are already up to date.")
+    parser.add_option('-j', '--jobs', type="int", default=1, help="Number of dependencies (or source repos, with --source) to fetch at once.")
+    parser.add_option('--report', default=None, metavar='PATH', help="Write a JSON report of what was fetched, with sizes and timings, to PATH.")
+    parser.add_option('--lock', action="store_true", default=False, help="Write the resolved dependencies to projectdata/dependencies.lock.json, for builds to use.")
     options, args = parser.parse_args()
-    if len(args)==0 and not options.clean and not options.nuget and not options.all and not options.source and not options.list:
+    if len(args)==0 and not options.clean and not options.nuget and not options.all and not options.source and not options.list and not options.lock:
         options.clean = True
         options.all = True
         options.nuget = os.path.exists('projectdata/packages.config')
@@ -75,7 +84,11 @@ def main():
                 logfile=sys.stdout,
                 list_details=options.list,
                 verbose=options.verbose,
-                local_overrides=not options.no_overrides)
+                local_overrides=not options.no_overrides,
+                jobs=options.jobs,
+                force=options.force,
+                lock=options.lock,
+                report=options.report)
     except Exception as e:
         if options.verbose:
             traceback.print_exc()
@@ -4,15 +4,27 @@ import zipfile
 import re
 import urllib
 import urllib2
+import urlparse
 import platform
 import subprocess
 import json
 import shutil
+import tempfile
 import cStringIO
 import hashlib
 import stat
+import sys
+import time
+import socket
+import httplib
+import sqlite3
+import threading
+import zlib
+import Queue
+import StringIO
 from glob import glob
 from default_platform import default_platform
+from userlocks import FileLock
 
 # Master table of dependency types.
 
@@ -45,6 +57,23 @@ from default_platform import default_platform
 # In order for source control fetching to work, the string 'source-git' should point
 # to the git repo and 'tag' should identify the git tag that corresponds to the
 # fetched binaries.
+#
+# Optionally, 'sha256' pins the SHA-256 digest of the archive. The archive is
+# checked against it as it is downloaded, and a mismatch fails the fetch
+# before anything in 'dest' is touched.
+#
+# Setting 'delta-updates' to true lets a new version of an archive be built
+# from an old one in the download cache and a delta, if the server
+# publishes any (see fetch_delta). Otherwise it is downloaded in full.
+#
+# 'binary-mirrors' lists servers holding the same files as 'binary-repo'. An
+# 'archive-path' under 'binary-repo' is downloaded from whichever of them has
+# been fastest, moving to the next if it fails or stalls. For example, in
+# ../dependency_overrides.json:
+# {
+#     "name": "ohNet",
+#     "binary-mirrors": ["http://artifacts.office.example.com/artifacts"]
+# }
 
 DEPENDENCY_TYPES = {
     # Label a dependency with the 'ignore' type to prevent it being considered at all.
@@ -70,6 +99,7 @@ DEPENDENCY_TYPES = {
         'archive-prefix': '',
         'archive-suffix': '',
         'binary-repo': 'http://openhome.org/releases/artifacts',
+        'binary-mirrors': [],
         'archive-directory': '${binary-repo}/${name}/',
         'archive-filename': '${archive-prefix}${name}-${version}-${archive-platform}${archive-suffix}${archive-extension}',
         'remote-archive-path': '${archive-directory}${archive-filename}',
@@ -85,7 +115,8 @@ DEPENDENCY_TYPES = {
         'dest': 'dependencies/${archive-platform}/',
         'configure-args': [],
         'strip-archive-dirs': 0,
-        'allow-cache': False
+        'allow-cache': True,
+        'delta-updates': False
         },
 
     # Internal dependencies are named and structured in a similar manner
@@ -101,6 +132,7 @@ DEPENDENCY_TYPES = {
 
     'internal' : {
         'binary-repo': 'http://core.linn.co.uk/~artifacts/artifacts',
+        'binary-mirrors': [],
         'source-git': None,
         'any-platform': 'AnyPlatform',
         'platform-specific': True,
@@ -111,7 +143,8 @@ DEPENDENCY_TYPES = {
         'dest': 'dependencies/${archive-platform}/',
         'configure-args': [],
         'strip-archive-dirs': 0,
-        'allow-cache': False
+        'allow-cache': True,
+        'delta-updates': False
         },
 
     # External dependencies generally don't have a git repo, and even if they do,
@@ -126,6 +159,7 @@ DEPENDENCY_TYPES = {
     #     configure-args
     'external' : {
         'binary-repo': 'http://openhome.org/releases/artifacts',
+        'binary-mirrors': [],
         'source-git': None,
         'any-platform': 'AnyPlatform',
         'platform-specific': True,
@@ -134,7 +168,8 @@ DEPENDENCY_TYPES = {
         'dest': 'dependencies/${archive-platform}/',
         'configure-args': [],
         'strip-archive-dirs': 0,
-        'allow-cache': False
+        'allow-cache': True,
+        'delta-updates': False
         },
 
     # Ex-nuget dependencies don't have a git repo, but they are always
@@ -147,13 +182,15 @@ DEPENDENCY_TYPES = {
     'exnuget' : {
         'archive-extension': '.tar.gz',
         'binary-repo': 'http://openhome.org/releases/artifacts',
+        'binary-mirrors': [],
         'archive-directory': '${binary-repo}/nuget/',
         'archive-filename': '${name}.${version}${archive-extension}',
         'archive-path': '${archive-directory}${archive-filename}',
         'dest': 'dependencies/nuget/',
         'configure-args': [],
         'strip-archive-dirs': 0,
-        'allow-cache': False
+        'allow-cache': True,
+        'delta-updates': False
         },
     }
 
@@ -172,10 +209,48 @@ def windows_program_exists(program):
     return subprocess.call(["which", "/q", program], shell=False)==0
 
 def other_program_exists(program):
-    return subprocess.call(["/bin/sh", "-c", "command -v "+program], shell=False, stdout=open(os.devnull), stderr=open(os.devnull))==0
+    return subprocess.call(["/bin/sh", "-c", "command -v "+program], shell=False, stdout=open(os.devnull, "w"), stderr=open(os.devnull, "w"))==0
 
 program_exists = windows_program_exists if platform.platform().startswith("Windows") else other_program_exists
 
+def parallel_map(function, items, jobs=1):
+    '''
+    Apply function to each of items using at most 'jobs' worker threads
+    and return the results in the same order as items. With jobs of 1 or
+    less, everything runs on the calling thread. If any call raises, the
+    first exception is re-raised once all the workers have finished.
+    '''
+    items = list(items)
+    if jobs is None or jobs <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+    results = [None] * len(items)
+    errors = []
+    work = Queue.Queue()
+    for index, item in enumerate(items):
+        work.put((index, item))
+    def worker():
+        while True:
+            try:
+                index, item = work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = function(item)
+            except:
+                errors.append(sys.exc_info())
+    threads = [threading.Thread(target=worker) for i in range(min(jobs, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # Join with a timeout so that KeyboardInterrupt still gets through.
+        while thread.is_alive():
+            thread.join(0.1)
+    if errors:
+        etype, evalue, etraceback = errors[0]
+        raise etype, evalue, etraceback
+    return results
+
 
 
 def scp(source, target):
@@ -232,78 +307,1018 @@ def open_file_url(url):
     return open(final_path, "rb")
 
 
+# Buffer size for copying archive data between files and sockets.
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# Zip archives need random access, so they are spooled to a temporary
+# file on disk once they grow beyond this many bytes. Tar archives are
+# always extracted straight from the stream.
+ZIP_SPOOL_THRESHOLD = 16 * 1024 * 1024
+
+def read_fully(fileobj, size):
+    chunks = []
+    while size > 0:
+        chunk = fileobj.read(min(size, COPY_BUFFER_SIZE))
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+def spool(fileobj, max_size=None):
+    '''
+    Copy fileobj into a seekable file, held in memory up to max_size bytes
+    (by default ZIP_SPOOL_THRESHOLD) and in a temporary file on disk beyond
+    that. Returns the file and the path of the temporary file, if any,
+    which the caller must delete.
+    '''
+    if max_size is None:
+        max_size = ZIP_SPOOL_THRESHOLD
+    head = read_fully(fileobj, max_size + 1)
+    if len(head) <= max_size:
+        return cStringIO.StringIO(head), None
+    fd, path = tempfile.mkstemp(suffix='.spool')
+    spooled = os.fdopen(fd, 'w+b')
+    spooled.write(head)
+    shutil.copyfileobj(fileobj, spooled, COPY_BUFFER_SIZE)
+    spooled.seek(0)
+    return spooled, path
+
+
 class FileCache(object):
+    '''
+    A cache of downloaded files, bounded by the total size of its contents.
+    Each entry is a directory holding the original name, the content and
+    any HTTP validators (ETag and Last-Modified) it was served with.
+    Downloads in progress are written to partial files alongside the
+    entries, so that an interrupted download can be resumed later.
+    Entries are assembled in staging directories and renamed into place,
+    so that a reader never sees one half written, even from another
+    process sharing the cache. Writers hold a lock file per entry (see
+    lock_entry) so that only one of them downloads it at a time.
+    An sqlite index records the size, last access time and hit count of
+    every entry, so that the least recently used entries can be evicted
+    without scanning the cache directory. It also maps the SHA-256 of each
+    downloaded entry's content to its name, so that content can be found
+    by digest alone.
+    '''
     ENTRY_PREFIX = "URL_CACHE_ENTRY."
-    def __init__(self, path, size):
+    PARTIAL_PREFIX = "URL_CACHE_PARTIAL."
+    STAGING_PREFIX = "URL_CACHE_STAGING."
+    LOCK_PREFIX = "URL_CACHE_LOCK."
+    PARTIAL_MAX_AGE = 7 * 24 * 60 * 60
+    INDEX_FILENAME = "index.sqlite"
+    def __init__(self, path, max_bytes):
         if not os.path.isdir(path):
             os.makedirs(path)
         self.path = path
-        self.size = size
-    def clean(self):
-        names = glob(self.path + '/' + self.ENTRY_PREFIX + '*')
-        names.sort(key = os.path.getmtime)
-        if len(names) > self.size:
-            to_delete = names[:-self.size]
-            for path in to_delete:
-                shutil.rmtree(path)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        index_path = path + '/' + self.INDEX_FILENAME
+        new_index = not os.path.isfile(index_path)
+        self.db = sqlite3.connect(index_path, timeout=60, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS entries (name TEXT PRIMARY KEY, size INTEGER, last_access REAL, hits INTEGER)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS entries_by_last_access ON entries (last_access)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS digests (sha256 TEXT PRIMARY KEY, name TEXT)")
+            for stat_name in ['hits', 'misses', 'bytes_saved']:
+                self.db.execute("INSERT OR IGNORE INTO stats VALUES (?, 0)", (stat_name,))
+        if new_index:
+            # Adopt entries left by versions that had no index.
+            self.verify()
+    def _bump(self, stat_name, amount=1):
+        self.db.execute("UPDATE stats SET value = value + ? WHERE name = ?", (amount, stat_name))
+    def _entry_name(self, path):
+        with open(path+'/filename', 'r') as f:
+            return f.read().strip()
+    def clean(self, max_bytes=None, keep=None):
+        '''
+        Evict least recently used entries until the cache fits in max_bytes
+        (by default, the size it was created with). The entry named keep is
+        never evicted. Returns the number of entries evicted.
+        '''
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        evicted = []
+        with self.lock, self.db:
+            total, = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()
+            while total > max_bytes:
+                row = self.db.execute("SELECT name, size FROM entries WHERE name IS NOT ? ORDER BY last_access LIMIT 1", (keep,)).fetchone()
+                if row is None:
+                    break
+                name, size = row
+                self.db.execute("DELETE FROM entries WHERE name = ?", (name,))
+                total -= size
+                evicted.append(name)
+        # Deleted once the index is committed, so that other processes
+        # aren't kept waiting for it.
+        for name in evicted:
+            self._evict(name)
+        return len(evicted)
+    def _evict(self, name):
+        lock = self.lock_entry(name, blocking=False)
+        if lock is None:
+            # Someone is writing it anew, and will replace what's there.
+            return
+        try:
+            self._remove_entry(self.path_for_name(name))
+        finally:
+            lock.release(remove=True)
     def path_for_name(self, name):
         digest = hashlib.md5(name).hexdigest()
         return self.path + '/' + self.ENTRY_PREFIX + digest
-    def put(self, name, content):
-        path = self.path_for_name(name)
-        if os.path.isdir(path):
-            shutil.rmtree(path)
-        os.mkdir(path)
-        with open(path+'/filename', 'w') as f:
+    def partial_path_for_name(self, name):
+        digest = hashlib.md5(name).hexdigest()
+        return self.path + '/' + self.PARTIAL_PREFIX + digest
+    def lock_path_for_name(self, name):
+        digest = hashlib.md5(name).hexdigest()
+        return self.path + '/' + self.LOCK_PREFIX + digest
+    def lock_entry(self, name, blocking=True):
+        '''
+        Take the lock for writing the entry for name, shared with other
+        processes using the cache. Returns the held FileLock, to be
+        released by the caller, or None if blocking is false and someone
+        else holds it. Reading entries needs no lock.
+        '''
+        lock = FileLock(self.lock_path_for_name(name))
+        return lock if lock.acquire(blocking) else None
+    def _new_entry(self, name):
+        # Stage next to the entries, so that the result can be renamed in.
+        staging_path = tempfile.mkdtemp(prefix=self.STAGING_PREFIX, dir=self.path)
+        with open(staging_path+'/filename', 'w') as f:
             f.write(name)
-        with open(path+'/content', 'wb') as f:
-            f.write(content.read())
-    def get(self, name, mode='r'):
+        return staging_path
+    def _remove_entry(self, path):
+        # Rename it out of the way first, so that nobody sees it half deleted.
+        trash_path = tempfile.mkdtemp(prefix=self.STAGING_PREFIX, dir=self.path)
+        try:
+            os.rename(path, trash_path + '/entry')
+        except OSError:
+            if os.path.isdir(path):
+                raise
+        shutil.rmtree(trash_path, ignore_errors=True)
+    def _add_entry(self, name, staging_path, validators, digest=None):
+        if validators:
+            with open(staging_path+'/validators', 'w') as f:
+                json.dump(validators, f)
+        if digest is not None:
+            with open(staging_path+'/sha256', 'w') as f:
+                f.write(digest)
+        size = os.path.getsize(staging_path+'/content')
         path = self.path_for_name(name)
-        if not os.path.isdir(path):
+        while True:
+            if os.path.isdir(path):
+                self._remove_entry(path)
+            try:
+                os.rename(staging_path, path)
+                break
+            except OSError:
+                # Someone else put an entry there in the meantime.
+                if not os.path.isdir(path):
+                    raise
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, 0)", (name, size, time.time()))
+            if digest is not None:
+                self.db.execute("INSERT OR REPLACE INTO digests VALUES (?, ?)", (digest, name))
+    def put(self, name, content, validators=None):
+        staging_path = self._new_entry(name)
+        with open(staging_path+'/content', 'wb') as f:
+            shutil.copyfileobj(content, f, COPY_BUFFER_SIZE)
+        self._add_entry(name, staging_path, validators)
+    def get_partial(self, name):
+        '''
+        Returns the size and validator of an interrupted download of name,
+        or (0, None) if there is none that can be resumed.
+        '''
+        partial_path = self.partial_path_for_name(name)
+        try:
+            with open(partial_path+'.validator', 'r') as f:
+                details = json.load(f)
+            if details['name'] != name:
+                return 0, None
+            return os.path.getsize(partial_path), details['validator']
+        except (IOError, OSError, ValueError, KeyError):
+            return 0, None
+    def open_partial(self, name, offset, validator):
+        '''
+        Open the partial file for a download of name, positioned to write
+        at offset. The validator identifies the version being downloaded,
+        and is needed to resume it. Use commit_partial once it is complete.
+        '''
+        partial_path = self.partial_path_for_name(name)
+        if validator is None:
+            if os.path.isfile(partial_path+'.validator'):
+                os.remove(partial_path+'.validator')
+        else:
+            with open(partial_path+'.validator', 'w') as f:
+                json.dump({'name':name, 'validator':validator}, f)
+        f = open(partial_path, 'r+b' if offset > 0 else 'wb')
+        f.seek(offset)
+        f.truncate()
+        return f
+    def commit_partial(self, name, validators=None, digest=None):
+        partial_path = self.partial_path_for_name(name)
+        staging_path = self._new_entry(name)
+        os.rename(partial_path, staging_path+'/content')
+        if os.path.isfile(partial_path+'.validator'):
+            os.remove(partial_path+'.validator')
+        self._add_entry(name, staging_path, validators, digest)
+    def discard_partial(self, name):
+        partial_path = self.partial_path_for_name(name)
+        for path in [partial_path, partial_path+'.validator']:
+            if os.path.isfile(path):
+                os.remove(path)
+    def get_digest(self, name):
+        '''
+        Returns the SHA-256 of the entry's content, if it was recorded when
+        the entry was downloaded.
+        '''
+        path = self.path_for_name(name)
+        try:
+            if self._entry_name(path) != name:
+                return None
+            with open(path+'/sha256', 'r') as f:
+                return f.read().strip()
+        except IOError:
             return None
-        if not os.path.isfile(path+'/filename'):
+    def name_for_digest(self, digest):
+        '''
+        Returns the name of an entry whose SHA-256 is digest, or None if
+        there is none.
+        '''
+        with self.lock:
+            row = self.db.execute("SELECT name FROM digests WHERE sha256 = ?", (digest,)).fetchone()
+        if row is None:
             return None
-        with open(path+'/filename', 'r') as f:
-            filename = f.read().strip()
-        if filename != name:
+        if self.get_digest(row[0]) == digest:
+            return row[0]
+        self._forget_digest(digest)
+        return None
+    def _forget_digest(self, digest):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM digests WHERE sha256 = ?", (digest,))
+    def get_by_digest(self, digest, mode='rb'):
+        '''
+        Returns the content of an entry whose SHA-256 is digest, whatever
+        its name, or None if there is none.
+        '''
+        name = self.name_for_digest(digest)
+        if name is None:
             return None
-        return open(path+'/content', mode)
+        f = self.get(name, mode)
+        if f is None:
+            self._forget_digest(digest)
+        return f
+    def get(self, name, mode='r'):
+        path = self.path_for_name(name)
+        with self.lock, self.db:
+            row = self.db.execute("SELECT size FROM entries WHERE name = ?", (name,)).fetchone()
+            try:
+                # Once open, the content stays readable even if the entry is
+                # replaced or evicted.
+                f = self.open_content(name, mode) if row is not None and self._entry_name(path) == name else None
+            except IOError:
+                f = None
+            if f is None:
+                if row is not None:
+                    self.db.execute("DELETE FROM entries WHERE name = ?", (name,))
+                self._bump('misses')
+                return None
+            self.db.execute("UPDATE entries SET last_access = ?, hits = hits + 1 WHERE name = ?", (time.time(), name))
+            self._bump('hits')
+            self._bump('bytes_saved', row[0])
+        return f
+    def get_validators(self, name):
+        '''
+        Returns the HTTP validators stored with the entry, or None if there
+        is no such entry or it was stored without any.
+        '''
+        path = self.path_for_name(name)
+        try:
+            if self._entry_name(path) != name:
+                return None
+            with open(path+'/validators', 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+    def entry_stamp(self, name):
+        '''
+        Returns something that changes whenever the entry for name is
+        replaced, or None if there is no entry.
+        '''
+        try:
+            st = os.stat(self.path_for_name(name)+'/content')
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime, st.st_size)
+    def open_content(self, name, mode='rb'):
+        # Open an entry without counting it as a hit, e.g. just after put.
+        return open(self.path_for_name(name)+'/content', mode)
+    def stats(self):
+        '''
+        Returns a dictionary of entry count, total size, hits, misses and
+        bytes saved by hits since the cache was created.
+        '''
+        with self.lock:
+            result = dict(self.db.execute("SELECT name, value FROM stats").fetchall())
+            result['entries'], result['bytes'] = self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        result['max_bytes'] = self.max_bytes
+        lookups = result['hits'] + result['misses']
+        result['hit_ratio'] = float(result['hits']) / lookups if lookups else 0.0
+        return result
+    def verify(self):
+        '''
+        Check the index against the cache directory. Index rows whose entry
+        is missing or damaged are dropped, and entry directories missing
+        from the index are adopted or deleted. Returns a list of problems
+        found.
+        '''
+        problems = []
+        removed = []
+        with self.lock, self.db:
+            indexed = dict(self.db.execute("SELECT name, size FROM entries").fetchall())
+            for name, size in indexed.items():
+                path = self.path_for_name(name)
+                content_path = path+'/content'
+                if not os.path.isfile(content_path):
+                    problems.append("missing content for '{0}'".format(name))
+                elif os.path.getsize(content_path) != size:
+                    problems.append("wrong size for '{0}'".format(name))
+                else:
+                    continue
+                self.db.execute("DELETE FROM entries WHERE name = ?", (name,))
+                removed.append(path)
+            indexed_paths = set(self.path_for_name(name) for name in indexed)
+            for path in glob(self.path + '/' + self.ENTRY_PREFIX + '*'):
+                if path in indexed_paths:
+                    continue
+                try:
+                    name = self._entry_name(path)
+                    size = os.path.getsize(path+'/content')
+                except (IOError, OSError):
+                    problems.append("removed damaged entry '{0}'".format(os.path.basename(path)))
+                    removed.append(path)
+                    continue
+                if self.path_for_name(name) != path:
+                    problems.append("removed misnamed entry '{0}'".format(os.path.basename(path)))
+                    removed.append(path)
+                    continue
+                self.db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, 0)", (name, size, os.path.getmtime(path+'/content')))
+        # As in clean, deleted outside the transaction.
+        for path in removed:
+            self._remove_entry(path)
+        for path in glob(self.path + '/' + self.LOCK_PREFIX + '*'):
+            # Locks for entries that are gone, such as those evicted by
+            # versions that left them behind.
+            digest = os.path.basename(path)[len(self.LOCK_PREFIX):]
+            if os.path.isdir(self.path + '/' + self.ENTRY_PREFIX + digest):
+                continue
+            lock = FileLock(path)
+            if lock.acquire(blocking=False):
+                lock.release(remove=True)
+        for path in glob(self.path + '/' + self.PARTIAL_PREFIX + '*'):
+            if os.path.isfile(path) and time.time() - os.path.getmtime(path) > self.PARTIAL_MAX_AGE:
+                problems.append("removed abandoned download '{0}'".format(os.path.basename(path)))
+                os.remove(path)
+        for path in glob(self.path + '/' + self.STAGING_PREFIX + '*'):
+            if time.time() - os.path.getmtime(path) > self.PARTIAL_MAX_AGE:
+                problems.append("removed abandoned staging directory '{0}'".format(os.path.basename(path)))
+                shutil.rmtree(path, ignore_errors=True)
+        return problems
 
 
+class MirrorStats(object):
+    '''
+    The latency and throughput of each host that archives are downloaded
+    from, used to rank mirrors of the same file, fastest first. They are
+    kept across runs in a JSON file at path, if given. Hosts that haven't
+    been measured for PROBE_INTERVAL are probed with a one byte Range
+    request before they are ranked. A host that fails is ranked last for
+    FAILURE_PENALTY seconds, or until it succeeds again.
+    '''
+    PROBE_INTERVAL = 24 * 60 * 60
+    PROBE_TIMEOUT = 5
+    FAILURE_PENALTY = 10 * 60
+    # Weight given to each new measurement in the running averages.
+    SMOOTHING = 0.3
+    # Hosts are compared by how long they would take to send this much,
+    # assuming ASSUMED_THROUGHPUT for hosts that haven't sent that much.
+    TYPICAL_SIZE = 8 * 1024 * 1024
+    ASSUMED_THROUGHPUT = 1024 * 1024
+    MIN_MEASURED_SIZE = 256 * 1024
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.hosts = None
+        self.changed = set()
+        self.probed = set()
+    def host(self, url):
+        parts = urlparse.urlsplit(url)
+        return '{0}://{1}'.format(parts.scheme, parts.netloc)
+    def _load(self):
+        if self.path is None:
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+    def _update(self, url, update):
+        host = self.host(url)
+        with self.lock:
+            if self.hosts is None:
+                self.hosts = self._load()
+            stats = self.hosts.setdefault(host, {})
+            update(stats)
+            stats['updated'] = time.time()
+            self.changed.add(host)
+            if self.path is None:
+                return
+            # Keep what other processes have learnt about other hosts.
+            hosts = self._load()
+            hosts.update((host, self.hosts[host]) for host in self.changed)
+            try:
+                ensure_directory(os.path.dirname(self.path))
+                temp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+                with open(temp_path, 'w') as f:
+                    json.dump(hosts, f, indent=1)
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                os.rename(temp_path, self.path)
+            except (IOError, OSError):
+                pass
+    def _average(self, stats, key, value):
+        old = stats.get(key)
+        stats[key] = value if old is None else old + self.SMOOTHING * (value - old)
+    def record_latency(self, url, seconds):
+        def update(stats):
+            self._average(stats, 'latency', seconds)
+            stats.pop('failed', None)
+        self._update(url, update)
+    def record_throughput(self, url, size, seconds):
+        if size < self.MIN_MEASURED_SIZE or seconds <= 0:
+            return
+        self._update(url, lambda stats: self._average(stats, 'throughput', size / seconds))
+    def record_failure(self, url):
+        self._update(url, lambda stats: stats.__setitem__('failed', time.time()))
+    def probe(self, url):
+        started = time.time()
+        try:
+            response = urllib2.urlopen(urllib2.Request(url, headers={'Range':'bytes=0-0'}), timeout=self.PROBE_TIMEOUT)
+            response.close()
+        except urllib2.HTTPError as e:
+            if e.code >= 500 or e.code in [404, 410]:
+                self.record_failure(url)
+                return
+        except (IOError, socket.error, httplib.HTTPException):
+            self.record_failure(url)
+            return
+        self.record_latency(url, time.time() - started)
+    def rank(self, urls):
+        '''
+        Returns urls, which should have the same content, in the order to
+        try them: healthy hosts first, fastest first.
+        '''
+        if len(urls) < 2:
+            return urls
+        now = time.time()
+        with self.lock:
+            if self.hosts is None:
+                self.hosts = self._load()
+            to_probe = []
+            for url in urls:
+                host = self.host(url)
+                if host not in self.probed and now - self.hosts.get(host, {}).get('updated', 0) > self.PROBE_INTERVAL:
+                    self.probed.add(host)
+                    to_probe.append(url)
+        parallel_map(self.probe, to_probe, len(to_probe))
+        def order(item):
+            index, url = item
+            with self.lock:
+                stats = self.hosts.get(self.host(url), {})
+            failed = now - stats.get('failed', 0) < self.FAILURE_PENALTY
+            latency = stats.get('latency', self.PROBE_TIMEOUT)
+            throughput = stats.get('throughput', self.ASSUMED_THROUGHPUT)
+            return (failed, latency + float(self.TYPICAL_SIZE) / throughput, index)
+        return [url for index, url in sorted(enumerate(urls), key=order)]
+
 class FileFetcher(object):
-    def __init__(self, cache):
+    '''
+    Opens dependency archives wherever they are, keeping downloads in a
+    FileCache. If upstream is set to the URL of a caching server, such as
+    one run by 'go cache-server', HTTP and HTTPS downloads are requested
+    from it first, and from their origin if it fails. URLs with mirrors
+    are requested from the mirror that mirror_stats ranks first, and from
+    the others in turn if it fails.
+    '''
+    def __init__(self, cache, upstream=None, mirror_stats=None):
         self.cache = cache
-    def fetch(self, path, allow_cached=False):
+        self.upstream = upstream.rstrip('/') if upstream else None
+        self.mirror_stats = mirror_stats or MirrorStats(None)
+        self.mirrors = {}
+        self.connections = ConnectionPool()
+        self.transfers = {}
+        self.transfers_lock = threading.Lock()
+    def set_concurrency(self, jobs):
+        # Keep enough connections open for every worker fetching at once.
+        self.connections.max_idle_per_host = max(jobs or 1, 1)
+    def upstream_url(self, url):
+        return '{0}/fetch?url={1}'.format(self.upstream, urllib.quote(url, safe=''))
+    def urlopen(self, url, headers=None):
+        if self.upstream is not None and urlparse.urlsplit(url).scheme in ['http', 'https']:
+            try:
+                return self.connections.urlopen(self.upstream_url(url), headers)
+            except urllib2.HTTPError as e:
+                # The caching server passes on what the origin said, such as
+                # 304 or 404, but answers 502 if it couldn't reach it.
+                if e.code < 500:
+                    raise
+            except (IOError, socket.error, httplib.HTTPException):
+                # Don't wait for it to time out on every other file too.
+                self.upstream = None
+        mirrors = self.mirrors.get(url)
+        if not mirrors:
+            return self.connections.urlopen(url, headers)
+        error = None
+        for candidate in self.mirror_stats.rank([url] + mirrors):
+            started = time.time()
+            try:
+                response = self.connections.urlopen(candidate, headers)
+            except urllib2.HTTPError as e:
+                # A mirror may not have every file yet, but other answers,
+                # such as 304, are the same from any of them.
+                if e.code < 500 and e.code not in [404, 410]:
+                    raise
+                self.mirror_stats.record_failure(candidate)
+                error = e
+                continue
+            except (IOError, socket.error, httplib.HTTPException) as e:
+                self.mirror_stats.record_failure(candidate)
+                error = e
+                continue
+            self.mirror_stats.record_latency(candidate, time.time() - started)
+            return response
+        raise error
+    def read_failed(self, url, error):
+        # A download from url failed part way, e.g. stalled, so until it
+        # recovers, resume it from another mirror.
+        self.mirror_stats.record_failure(url)
+    def record_transfer(self, path, stats):
+        with self.transfers_lock:
+            self.transfers.setdefault(path, {}).update(stats)
+    def pop_transfer(self, path):
+        '''
+        Returns what was recorded about the last network transfer for path:
+        bytes-downloaded, time-to-first-byte and download-seconds, as far as
+        they are known.
+        '''
+        with self.transfers_lock:
+            return self.transfers.pop(path, {})
+    def fetch(self, path, allow_cached=False, sha256=None, mirrors=None, deltas=False):
+        '''
+        Open path, which may be a URL, and return the file and how it was
+        fetched: 'file', 'web', 'cache' or 'delta'. If sha256 is given,
+        downloads into the cache are checked against it, and any cached
+        content with that digest is used without asking the server.
+        mirrors are other URLs with the same content as path. Whichever is
+        used, the file is cached as path. If deltas is true, a URL that
+        isn't cached is built from a delta if possible (see fetch_delta).
+        '''
         if path.startswith("file:") or path.startswith("smb:"):
             return self.fetch_file_url(path)
         if re.match("[^\W\d]{2,8}:", path):
-            return self.fetch_url(path, allow_cached)
+            if mirrors:
+                self.mirrors[path] = mirrors
+            return self.fetch_url(path, allow_cached, sha256, deltas)
         return self.fetch_local(path)
     def fetch_local(self, path):
         return open(path, mode="rb"), 'file'
+    def is_remote(self, path):
+        # True for URLs that are downloaded, and so cached, rather than read.
+        return bool(re.match("[^\W\d]{2,8}:", path)) and not (path.startswith("file:") or path.startswith("smb:"))
+    def cached_digest(self, path):
+        # The SHA-256 of a URL's cached content, known without reading it.
+        if self.is_remote(path):
+            return self.cache.get_digest(path)
+        return None
+    def stat(self, path):
+        '''
+        Returns [size, mtime] for local and file: paths, used to tell if
+        they have changed, or None for remote paths or missing files.
+        '''
+        if self.is_remote(path):
+            return None
+        try:
+            f = self.fetch(path)[0]
+        except (IOError, OSError):
+            return None
+        try:
+            st = os.fstat(f.fileno())
+            return [st.st_size, st.st_mtime]
+        finally:
+            f.close()
     def fetch_file_url(self, path):
         return open_file_url(path), 'file'
-    def fetch_url(self, path, allow_cached):
+    def fetch_url(self, path, allow_cached, sha256=None, deltas=False):
+        started = time.time()
         if not allow_cached:
-            return urlopen(path), 'web'
-        f = self.cache.get(path, mode="rb")
-        if f is not None:
-            return f, 'cache'
-        f = urlopen(path)
-        self.cache.put(path, f)
-        self.cache.clean()
-        f.seek(0)
-        return f, 'web'
-
-
-def urlopen(url):
-    fileobj = urllib2.urlopen(url)
-    try:
-        contents = fileobj.read()
-        return cStringIO.StringIO(contents)
-    finally:
-        fileobj.close()
+            f = self.urlopen(path)
+            self.record_transfer(path, {'time-to-first-byte': time.time() - started})
+            return ResumableResponse(path, f, opener=self.urlopen, on_error=self.read_failed), 'web'
+        if sha256 is not None:
+            # Content is identified by its digest, so there's nothing to
+            # ask the server.
+            f = self.cache.get_by_digest(sha256)
+            if f is not None:
+                return f, 'cache'
+        stamp = self.cache.entry_stamp(path)
+        lock = self.cache.lock_entry(path, blocking=False)
+        if lock is None:
+            # Someone else, maybe another build sharing the cache, is
+            # downloading it right now. Wait and use their copy rather than
+            # downloading it again.
+            lock = self.cache.lock_entry(path)
+            if self.cache.entry_stamp(path) not in [None, stamp]:
+                f = self.cache.get_by_digest(sha256) if sha256 is not None else self.cache.get(path, mode="rb")
+                if f is not None:
+                    lock.release()
+                    return f, 'cache'
+        try:
+            attempts = len(self.mirrors.get(path, [])) + 1
+            for attempt in range(attempts):
+                try:
+                    return self._fetch_url_locked(path, sha256, started, deltas)
+                except (urllib2.HTTPError, DigestMismatch):
+                    # Every mirror has been asked already, or the file is
+                    # the wrong one, whichever mirror it came from.
+                    raise
+                except (IOError, socket.error, httplib.HTTPException):
+                    # A mirror failed part way, and the next could not
+                    # resume its download. Start again from the best
+                    # mirror left.
+                    if attempt + 1 == attempts:
+                        raise
+        finally:
+            lock.release()
+    def _fetch_url_locked(self, path, sha256, started, deltas=False):
+        # The caller holds the cache's lock for the entry.
+        headers = {}
+        partial_size, partial_validator = self.cache.get_partial(path)
+        if deltas and partial_validator is None and self.cache.entry_stamp(path) is None:
+            f = self.fetch_delta(path, sha256, started)
+            if f is not None:
+                return f, 'delta'
+        # A cached copy that doesn't match a pinned digest is no use, even
+        # if the server says it is current.
+        validators = self.cache.get_validators(path) if sha256 is None else None
+        if partial_validator is not None:
+            # An earlier download was interrupted. Ask for the rest of it,
+            # unless the file has changed since.
+            headers['Range'] = 'bytes={0}-'.format(partial_size)
+            headers['If-Range'] = partial_validator
+        elif validators is not None:
+            # A cached copy is only used once the server confirms that it is
+            # still current, which costs one round trip and no body.
+            if 'etag' in validators:
+                headers['If-None-Match'] = validators['etag']
+            if 'last-modified' in validators:
+                headers['If-Modified-Since'] = validators['last-modified']
+        try:
+            f = self.urlopen(path, headers)
+        except urllib2.HTTPError as e:
+            if e.code == 304:
+                self.record_transfer(path, {'time-to-first-byte': time.time() - started})
+                f = self.cache.get(path, mode="rb")
+                if f is not None:
+                    return f, 'cache'
+            elif e.code != 416:
+                raise
+            # Either the entry was evicted since we read its validators, or
+            # the partial file is no use. Start again from scratch.
+            f = self.urlopen(path)
+        self.record_transfer(path, {'time-to-first-byte': time.time() - started})
+        validators = response_validators(f)
+        offset = partial_size if f.code == 206 else 0
+        source = f.geturl()
+        f = ResumableResponse(path, f, offset, opener=self.urlopen, on_error=self.read_failed)
+        try:
+            with self.cache.open_partial(path, offset, f.validator) as partial:
+                # The digest covers the part downloaded earlier, if any, too.
+                digest = hashlib.sha256()
+                if offset > 0:
+                    with open(partial.name, 'rb') as earlier:
+                        for chunk in iter(lambda: earlier.read(COPY_BUFFER_SIZE), ''):
+                            digest.update(chunk)
+                downloading = HashingReader(f, digest)
+                shutil.copyfileobj(downloading, partial, COPY_BUFFER_SIZE)
+        finally:
+            f.close()
+        self.record_transfer(path, {'bytes-downloaded': downloading.size, 'download-seconds': time.time() - started})
+        self.mirror_stats.record_throughput(source, downloading.size, time.time() - started)
+        if sha256 is not None and digest.hexdigest() != sha256:
+            self.cache.discard_partial(path)
+            raise DigestMismatch(digest_mismatch_message(path, digest.hexdigest(), sha256))
+        self.cache.commit_partial(path, validators, digest.hexdigest())
+        self.cache.clean(keep=path)
+        return self.cache.open_content(path), 'web'
+
+
+    def fetch_delta(self, path, sha256, started):
+        '''
+        Build the content of path from a delta and a base in the cache, and
+        add it to the cache. Returns the file, or None if there is no delta
+        to use, so that path should be downloaded in full.
+
+        Deltas are listed in a JSON index at path + DELTA_INDEX_SUFFIX:
+        {
+            "sha256": "<SHA-256 of the file at path>",
+            "deltas": [
+                {
+                    "base-sha256": "<SHA-256 of the file it applies to>",
+                    "format": "zstd",
+                    "path": "<URL of the delta, relative to the index>",
+                    "size": <size of the delta in bytes>
+                }
+            ]
+        }
+        The smallest delta whose base is cached, and whose format can be
+        applied here (see DELTA_FORMATS), is used. The result must match
+        "sha256", and sha256 if that is given too.
+        '''
+        try:
+            f = self.urlopen(path + DELTA_INDEX_SUFFIX)
+            try:
+                index = json.load(f)
+            finally:
+                f.close()
+            target_digest = index['sha256'].strip().lower()
+            deltas = sorted(index['deltas'], key=lambda delta: delta.get('size', 0))
+        except (IOError, socket.error, httplib.HTTPException, ValueError, KeyError, TypeError, AttributeError):
+            # Usually because none are published.
+            return None
+        if sha256 is not None and target_digest != sha256:
+            return None
+        for delta in deltas:
+            delta_format = delta.get('format')
+            if delta_format not in DELTA_FORMATS or not native_program(DELTA_FORMATS[delta_format][0]):
+                continue
+            base_name = self.cache.name_for_digest(str(delta.get('base-sha256', '')).strip().lower())
+            if base_name is None:
+                continue
+            try:
+                # Not a hit for the base, which is only read from.
+                base = self.cache.open_content(base_name)
+            except IOError:
+                # Evicted since.
+                continue
+            staging_path = tempfile.mkdtemp(prefix=self.cache.STAGING_PREFIX, dir=self.cache.path)
+            try:
+                delta_path = os.path.join(staging_path, 'delta')
+                response = self.urlopen(urlparse.urljoin(path + DELTA_INDEX_SUFFIX, delta['path']))
+                try:
+                    with open(delta_path, 'wb') as delta_file:
+                        shutil.copyfileobj(response, delta_file, COPY_BUFFER_SIZE)
+                finally:
+                    response.close()
+                delta_size = os.path.getsize(delta_path)
+                # The new entry gets no validators from this, so ask the
+                # server for them, to revalidate the entry with later.
+                response = self.urlopen(path, {'Range':'bytes=0-0'})
+                try:
+                    validators = response_validators(response)
+                    if response.code == 206:
+                        # Read the one byte, so that the connection can be
+                        # reused. A server that ignored the range would
+                        # send the whole file, so then it is dropped.
+                        response.read()
+                finally:
+                    response.close()
+                self.cache.open_partial(path, 0, None).close()
+                partial_path = self.cache.partial_path_for_name(path)
+                with tempfile.TemporaryFile() as output:
+                    code = subprocess.call(delta_command(delta_format, base.name, delta_path, partial_path), stdout=output, stderr=output)
+                digest = file_digest(partial_path)[0] if code == 0 else None
+            except (IOError, OSError, socket.error, httplib.HTTPException, KeyError):
+                digest = None
+            finally:
+                base.close()
+                shutil.rmtree(staging_path, ignore_errors=True)
+            if digest != target_digest:
+                self.cache.discard_partial(path)
+                continue
+            self.record_transfer(path, {'bytes-downloaded': delta_size, 'download-seconds': time.time() - started})
+            self.cache.commit_partial(path, validators, digest)
+            self.cache.clean(keep=path)
+            return self.cache.open_content(path)
+        return None
+
+
+# Deltas between versions of an archive, see FileFetcher.fetch_delta. Each
+# format is applied by a program, which is used if it is installed.
+DELTA_INDEX_SUFFIX = '.deltas'
+DELTA_FORMATS = {
+    'xdelta3': ('xdelta3', ['-d', '-f', '-s', '{base}', '{delta}', '{target}']),
+    'bsdiff': ('bspatch', ['{base}', '{target}', '{delta}']),
+    'zstd': ('zstd', ['-d', '-q', '-f', '--long=31', '--patch-from={base}', '{delta}', '-o', '{target}']),
+    }
+
+def delta_command(delta_format, base, delta, target):
+    program, args = DELTA_FORMATS[delta_format]
+    return [program] + [arg.format(base=base, delta=delta, target=target) for arg in args]
+
+def digest_mismatch_message(path, digest, expected):
+    return "SHA-256 of '{0}' is {1}, expected {2}".format(path, digest, expected)
+
+class DigestMismatch(IOError):
+    '''
+    A download didn't match its pinned digest. Unlike other IOErrors, this
+    isn't worth retrying, since every mirror should serve the same file.
+    '''
+
+def response_validators(response):
+    validators = {}
+    for key, header in [('etag', 'ETag'), ('last-modified', 'Last-Modified')]:
+        value = response.info().getheader(header)
+        if value is not None:
+            validators[key] = value
+    return validators
+
+class ResumableResponse(object):
+    '''
+    A file-like wrapper for an HTTP response. If the connection fails, or
+    the body ends short of its Content-Length, the rest is requested again
+    with a Range request. Attempts are spaced by a delay that doubles each
+    time, and are configured by 'download-retries' and
+    'download-retry-delay'.
+    '''
+    def __init__(self, url, response, offset=0, opener=None, on_error=None):
+        self.url = url
+        self.opener = opener or urlopen
+        self.on_error = on_error
+        self.response = response
+        self.headers = response.info()
+        self.offset = offset
+        validators = response_validators(response)
+        # Resuming is only safe if we can tell the server which version we
+        # have the beginning of.
+        self.validator = validators.get('etag', validators.get('last-modified'))
+        length = response.info().getheader('Content-Length')
+        self.length = offset + int(length) if length is not None else None
+        self.retries = int(get_config('download-retries', 5))
+        self.retry_delay = float(get_config('download-retry-delay', 1.0))
+    def info(self):
+        return self.headers
+    def read(self, size=-1):
+        if size < 0:
+            chunks = []
+            while True:
+                chunk = self.read(COPY_BUFFER_SIZE)
+                if not chunk:
+                    return ''.join(chunks)
+                chunks.append(chunk)
+        attempt = 0
+        while True:
+            try:
+                if self.response is None:
+                    self.response = self.reopen()
+                data = self.response.read(size)
+                if data or size == 0 or self.length is None or self.offset >= self.length:
+                    self.offset += len(data)
+                    return data
+                error = IOError("connection closed after {0} of {1} bytes".format(self.offset, self.length))
+            except (IOError, socket.error, httplib.HTTPException) as e:
+                error = e
+            if self.response is not None:
+                if self.on_error is not None:
+                    self.on_error(self.response.geturl(), error)
+                self.response.close()
+                self.response = None
+            if attempt >= self.retries or self.validator is None:
+                raise IOError("Download of '{0}' failed: {1}".format(self.url, error))
+            time.sleep(min(self.retry_delay * 2 ** attempt, 60))
+            attempt += 1
+    def reopen(self):
+        response = self.opener(self.url, {'Range':'bytes={0}-'.format(self.offset), 'If-Range':self.validator})
+        if response.code != 206:
+            # The file has changed, or the server doesn't support ranges.
+            response.close()
+            self.validator = None
+            raise IOError("cannot resume, the server did not honour the Range request")
+        return response
+    def close(self):
+        if self.response is not None:
+            self.response.close()
+
+
+def urlopen(url, headers=None):
+    # The response is returned unread, so that callers can stream it
+    # rather than hold the whole body in memory. The timeout turns a
+    # stalled connection into an error that can be retried.
+    timeout = float(get_config('download-timeout', 60))
+    return urllib2.urlopen(urllib2.Request(url, headers=headers or {}), timeout=timeout)
+
+class PooledResponse(object):
+    '''
+    An HTTP response on a pooled connection, with the parts of the
+    urllib2 response interface that FileFetcher uses. Closing it returns
+    the connection to the pool if the body was read to the end.
+    '''
+    def __init__(self, pool, key, connection, response, url):
+        self.pool = pool
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.url = url
+        self.code = response.status
+    def info(self):
+        return self.response.msg
+    def geturl(self):
+        return self.url
+    def read(self, size=-1):
+        if size < 0:
+            return self.response.read()
+        return self.response.read(size)
+    def close(self):
+        if self.connection is None:
+            return
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool.release(self.key, self.connection)
+        else:
+            self.response.close()
+            self.connection.close()
+        self.connection = None
+
+class ConnectionPool(object):
+    '''
+    Persistent HTTP and HTTPS connections, reused across requests to the
+    same host to save a TCP (and TLS) handshake per request. Up to
+    max_idle_per_host connections are kept open for each host, which
+    should match the number of concurrent fetches. Requests that need a
+    proxy are left to urllib2.
+    '''
+    MAX_REDIRECTS = 5
+    def __init__(self, max_idle_per_host=1):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.proxies = urllib.getproxies()
+    def connect(self, key):
+        scheme, netloc = key
+        timeout = float(get_config('download-timeout', 60))
+        connection_class = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+        return connection_class(netloc, timeout=timeout)
+    def acquire(self, key):
+        with self.lock:
+            connections = self.idle.get(key)
+            if connections:
+                return connections.pop(), True
+        return self.connect(key), False
+    def release(self, key, connection):
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.max_idle_per_host:
+                connections.append(connection)
+                return
+        connection.close()
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle = {}
+    def urlopen(self, url, headers=None):
+        for redirect in range(self.MAX_REDIRECTS + 1):
+            parts = urlparse.urlsplit(url)
+            if parts.scheme not in ['http', 'https'] or (parts.scheme in self.proxies and not urllib.proxy_bypass(parts.hostname)):
+                return urlopen(url, headers)
+            key = (parts.scheme, parts.netloc)
+            selector = urlparse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+            connection, reused = self.acquire(key)
+            try:
+                connection.request('GET', selector, headers=headers or {})
+                response = connection.getresponse()
+            except (socket.error, httplib.HTTPException):
+                connection.close()
+                if not reused:
+                    raise
+                # The server may have closed an idle connection. Try once
+                # more on a new one.
+                connection = self.connect(key)
+                connection.request('GET', selector, headers=headers or {})
+                response = connection.getresponse()
+            pooled = PooledResponse(self, key, connection, response, url)
+            if response.status in [301, 302, 303, 307, 308] and response.getheader('Location'):
+                response.read()
+                pooled.close()
+                url = urlparse.urljoin(url, response.getheader('Location'))
+                continue
+            if response.status >= 300:
+                response.read()
+                pooled.close()
+                raise urllib2.HTTPError(url, response.status, response.reason, response.msg, None)
+            return pooled
+        raise urllib2.HTTPError(url, response.status, "Too many redirects", response.msg, None)
 
 def get_opener_for_path(path):
     if path.startswith("file:") or path.startswith("smb:"):
@@ -317,8 +1332,22 @@ def is_trueish(value):
         value = value.upper()
     return value in [1, "1", "YES", "Y", "TRUE", "ON", True]
 
-class EnvironmentExpander(object):
-    # template_regex matches 
+class Template(object):
+    '''
+    A string value compiled into its literal text and the expansions it
+    contains. Each expansion is a tuple:
+        ('ref', key)                          ${key} or $key
+        ('conditional', key, primary, alternative)
+                                              ${key?primary:alternative}
+        ('lookup', table, key, key_is_ref)    ${table[key]} or ${table[$key]}
+        ('error', message)                    malformed, raised when used
+    If the whole string is a single expansion, it is also held in 'whole',
+    since it may then expand to any value, not just a string. If there are
+    no expansions, the resulting string is held in 'literal'. The keys it
+    might refer to are held in 'references', and those it always refers
+    to, whichever way its conditionals go, in 'required'.
+    '''
+    # template_regex matches $$, $word or ${any-thing}
     template_regex = re.compile(r"""
         (?x)                                # Enable whitespace and comments
         (?P<dollar>\$\$)|                   # Match $$
@@ -335,12 +1364,257 @@ class EnvironmentExpander(object):
         \]           # Match one close bracket: ]
         $
         """)
+    def __init__(self, value):
+        self.parts = []
+        self.whole = None
+        if '$' not in value:
+            self.parts = [value] if value else []
+            self.literal = value
+            self.references = self.required = frozenset()
+            return
+        position = 0
+        for match in self.template_regex.finditer(value):
+            if match.start() > position:
+                self.parts.append(value[position:match.start()])
+            self.parts.append(self.parsematch(match))
+            position = match.end()
+        if position < len(value):
+            self.parts.append(value[position:])
+        if len(self.parts) == 1 and isinstance(self.parts[0], tuple):
+            self.whole = self.parts[0]
+        self.literal = None
+        if not any(isinstance(part, tuple) for part in self.parts):
+            self.literal = ''.join(self.parts)
+        nodes = [part for part in self.parts if isinstance(part, tuple)]
+        self.references = frozenset(sum((self.nodereferences(node) for node in nodes), []))
+        self.required = frozenset(sum((self.nodereferences(node, required=True) for node in nodes), []))
+    def parsematch(self, match):
+        if match.group('dollar'):
+            return '$'
+        if match.group('word'):
+            return ('ref', match.group('word')[1:])
+        key = match.group('parens')[2:-1].strip()
+        if '[' in key:
+            index_match = self.index_regex.match(key)
+            if index_match is None:
+                return ('error', 'lookup must be of form ${table[key]}')
+            tablename = index_match.group(1).strip()
+            keyname = index_match.group(2).strip()
+            if keyname.startswith('$'):
+                return ('lookup', tablename, keyname[1:], True)
+            return ('lookup', tablename, keyname, False)
+        if '?' in key:
+            condition, rest = key.split('?', 1)
+            if ':' not in rest:
+                return ('error', 'conditional must be of form ${condition?result:alternative}')
+            primary, alternative = rest.split(':', 1)
+            return ('conditional', condition.strip(), primary.strip(), alternative.strip())
+        return ('ref', key)
+    @staticmethod
+    def nodereferences(node, required=False):
+        kind = node[0]
+        if kind == 'ref':
+            return [node[1]]
+        if kind == 'conditional':
+            # Only the condition is certain to be expanded.
+            return [node[1]] if required else list(node[1:])
+        if kind == 'lookup':
+            return [node[1], node[2]] if node[3] else [node[1]]
+        return []
+
+# Compiled templates, shared by every expander. Most strings come from
+# DEPENDENCY_TYPES, so each is parsed once rather than once per dependency.
+_templates = {}
+
+def compile_template(value):
+    template = _templates.get(value)
+    if template is None:
+        template = _templates[value] = Template(value)
+    return template
+
+def value_references(value, required=False):
+    '''
+    Returns the set of keys that expanding value might refer to, or if
+    required is set, only those it refers to whatever its conditions.
+    '''
+    if isinstance(value, basestring):
+        template = _templates.get(value) or compile_template(value)
+        return template.required if required else template.references
+    if isinstance(value, (list, tuple)):
+        return frozenset().union(*[value_references(x, required) for x in value])
+    if isinstance(value, dict):
+        return frozenset().union(*[value_references(x, required) for x in value.values()])
+    return frozenset()
+
+def reference_edges(env_dict, edges=None):
+    '''
+    Maps each key in env_dict whose value refers to other keys to the set of
+    keys it refers to. If edges is given, it is updated in place instead,
+    with keys of env_dict that refer to nothing removed from it.
+    '''
+    if edges is None:
+        edges = {}
+    for (key, value) in env_dict.items():
+        references = value_references(value)
+        if references:
+            edges[key] = references
+        else:
+            edges.pop(key, None)
+    return edges
+
+# Results of find_cyclic_keys, by reference graph. Dependencies of the
+# same type almost always share one, differing only in plain values.
+_cyclic_keys = {}
+
+def find_cyclic_keys(env_dict):
+    '''
+    Returns two sets of keys in env_dict: those that always refer back to
+    themselves, directly or through other keys, and those that could,
+    depending on which branch their conditionals take. Expanding one of
+    the first is always an error. One of the second is only an error if
+    the branches actually taken lead back to it.
+    '''
+    # Only keys whose values refer to other keys can be part of a cycle,
+    # and those edges are all that determine the result.
+    if isinstance(env_dict, LayeredEnvironment):
+        edges = env_dict.reference_edges()
+    else:
+        edges = reference_edges(env_dict)
+    edges = frozenset(edges.items())
+    possible = _cyclic_keys.get(edges)
+    if possible is None:
+        possible = _cyclic_keys[edges] = _find_cycles(dict(edges))
+    if not possible:
+        return possible, possible
+    # Rare enough not to cache. Any unconditional cycle lies within the
+    # possible ones.
+    required = dict((key, value_references(env_dict[key], required=True) & possible) for key in possible)
+    return _find_cycles(required), possible
+
+def _find_cycles(edges):
+    # Tarjan's strongly connected components algorithm.
+    graph = dict((key, [k for k in references if k in edges]) for (key, references) in edges.items())
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    cyclic = set()
+    def visit(key):
+        index[key] = lowlink[key] = len(index)
+        stack.append(key)
+        on_stack.add(key)
+        for other in graph[key]:
+            if other not in index:
+                visit(other)
+                lowlink[key] = min(lowlink[key], lowlink[other])
+            elif other in on_stack:
+                lowlink[key] = min(lowlink[key], index[other])
+        if lowlink[key] == index[key]:
+            component = []
+            while True:
+                other = stack.pop()
+                on_stack.remove(other)
+                component.append(other)
+                if other == key:
+                    break
+            if len(component) > 1 or key in graph[key]:
+                cyclic.update(component)
+    for key in graph:
+        if key not in index:
+            visit(key)
+    return frozenset(cyclic)
+
+class LayeredEnvironment(object):
+    '''
+    Read-only view of a stack of dicts, such as the base environment, the
+    dependency type's defaults, the definition and its overrides. A key
+    takes its value from the last layer that defines it. The layers are
+    shared, not copied, so must not be modified while the view is in use.
+    The first layer may itself be a LayeredEnvironment, which lets views
+    share the work of analysing their common layers.
+    '''
+    def __init__(self, *layers):
+        self.parent = None
+        if layers and isinstance(layers[0], LayeredEnvironment):
+            self.parent = layers[0]
+            layers = layers[1:]
+        self.own_layers = [layer for layer in layers if layer]
+        self.layers = self.own_layers[::-1]
+        if self.parent is not None:
+            self.layers += self.parent.layers
+        self.edges = None
+    def __getitem__(self, key):
+        for layer in self.layers:
+            if key in layer:
+                return layer[key]
+        raise KeyError(key)
+    def get(self, key, default=None):
+        for layer in self.layers:
+            if key in layer:
+                return layer[key]
+        return default
+    def defining_layer(self, key):
+        '''
+        Returns the layer that key takes its value from, or None.
+        '''
+        for layer in self.layers:
+            if key in layer:
+                return layer
+        return None
+    def __contains__(self, key):
+        for layer in self.layers:
+            if key in layer:
+                return True
+        return False
+    def keys(self):
+        if len(self.layers) == 1:
+            return self.layers[0].keys()
+        return list(set().union(*self.layers))
+    def items(self):
+        merged = {}
+        for layer in reversed(self.layers):
+            merged.update(layer)
+        return merged.items()
+    def reference_edges(self):
+        '''
+        As reference_edges(), for the combined layers. The result is cached
+        and must not be modified.
+        '''
+        if self.edges is None:
+            edges = dict(self.parent.reference_edges()) if self.parent is not None else {}
+            for layer in self.own_layers:
+                reference_edges(layer, edges)
+            self.edges = edges
+        return self.edges
+    def __len__(self):
+        return len(self.keys())
+
+def copy_value(value):
+    '''
+    Returns a copy of an expanded value that the caller may modify without
+    changing the environment it came from, such as the defaults in
+    DEPENDENCY_TYPES shared by every dependency of a type.
+    '''
+    if isinstance(value, list):
+        return [copy_value(x) for x in value]
+    if isinstance(value, dict):
+        return dict((k, copy_value(v)) for (k, v) in value.items())
+    return value
+
+class EnvironmentExpander(object):
+    '''
+    Expands the values of an environment on demand. Within it, lists and
+    tables are shared with the environment and between expansions, so
+    __getitem__, values and items return copies of them (see copy_value).
+    '''
     def __init__(self, env_dict):
         self.env_dict = env_dict
         self.cache = {}
+        self.cyclic_keys = None
+        self.possibly_cyclic_keys = None
         self.expandset = set()
     def __getitem__(self, key):
-        return self.expand(key)
+        return copy_value(self.expand(key))
     def getraw(self, key):
         return self.env_dict[key]
     def __contains__(self, key):
@@ -348,66 +1622,67 @@ class EnvironmentExpander(object):
     def keys(self):
         return self.env_dict.keys()
     def values(self):
-        return [self.expand(key) for key in self.keys()]
+        return [copy_value(self.expand(key)) for key in self.keys()]
     def items(self):
-        return [(key, self.expand(key)) for key in self.keys()]
+        return [(key, copy_value(self.expand(key))) for key in self.keys()]
     def expand(self, key):
         if key in self.cache:
             return self.cache[key]
-        if key in self.expandset:
+        if key not in self.env_dict:
+            raise KeyError("Key undefined:", key)
+        if self.cyclic_keys is None:
+            self.cyclic_keys, self.possibly_cyclic_keys = find_cyclic_keys(self.env_dict)
+        if key in self.cyclic_keys:
             raise ValueError("Recursive expansion for key:", key)
-        self.expandset.add(key)
-        result = self._expand(key)
+        if key in self.possibly_cyclic_keys:
+            # Whether this loops depends on the conditions, so track it.
+            if key in self.expandset:
+                raise ValueError("Recursive expansion for key:", key)
+            self.expandset.add(key)
+            try:
+                result = self._expandvalue(self.env_dict[key])
+            finally:
+                self.expandset.discard(key)
+        else:
+            result = self._expandvalue(self.env_dict[key])
         self.cache[key] = result
-        self.expandset.remove(key)
         return result
-    def _expand(self, key):
-        if key not in self.env_dict:
-            raise KeyError("Key undefined:", key)
-        value = self.env_dict[key]
-        return self._expandvalue(value)
     def _expandvalue(self, value):
         if isinstance(value, (str, unicode)):
             return self.expandstring(value)
-            #return self.template_regex.sub(self.replacematch, value)
+        elif not value_references(value):
+            # Nothing to expand. Lists and tables without references are
+            # returned as they are, shared with the environment, and only
+            # copied for callers outside the expander.
+            return value
         elif isinstance(value, (list, tuple)):
             return [self._expandvalue(x) for x in value]
         elif isinstance(value, dict):
             return dict((k, self._expandvalue(v)) for (k,v) in value.items())
         return value
     def expandstring(self, value):
-        firstmatch = self.template_regex.match(value)
-        if firstmatch is not None and firstmatch.group(0) == value and value != "$$":
+        template = _templates.get(value) or compile_template(value)
+        if template.whole is not None:
             # Special case: The entire string is a single expansion. In this case,
             # we allow the expansion to be *anything* (bool, int, list...),
             # not just a string.
-            return self.replacematch(firstmatch)
-        return self.template_regex.sub(self.replacematch, value)
-
-    def replacematch(self, match):
-        if match.group('dollar'):
-            return '$'
-        key = None
-        if match.group('word'):
-            key = match.group('word')[1:]
-        if match.group('parens'):
-            key = match.group('parens')[2:-1]
-        assert key is not None
-        key = key.strip()
-        if '[' in key:
-            return self.expandlookup(key)
-        if '?' in key:
-            return self.expandconditional(key)
-        return self.expand(key)
-    def expandlookup(self, key):
-        match = self.index_regex.match(key)
-        if match is None:
-            raise ValueError('lookup must be of form ${table[key]}')
-        tablename = match.group(1).strip()
-        keyname = match.group(2).strip()
+            return self.evaluate(template.whole)
+        if template.literal is not None:
+            return template.literal
+        return ''.join([self.evaluate(part) if isinstance(part, tuple) else part for part in template.parts])
+    def evaluate(self, node):
+        kind = node[0]
+        if kind == 'ref':
+            return self.expand(node[1])
+        if kind == 'conditional':
+            return self.expandconditional(*node[1:])
+        if kind == 'lookup':
+            return self.expandlookup(*node[1:])
+        raise ValueError(node[1])
+    def expandlookup(self, tablename, keyname, key_is_ref):
         table = self.expand(tablename)
-        if keyname.startswith('$'):
-            key = self.expand(keyname[1:])
+        if key_is_ref:
+            key = self.expand(keyname)
         else:
             key = keyname
         if not isinstance(table, dict):
@@ -419,14 +1694,7 @@ class EnvironmentExpander(object):
                 return table['*']
             raise KeyError("Key not in table, and no default '*' entry found: key={0!r}\ntable={1!r}".format(key, table))
         return table[key]
-    def expandconditional(self, key):
-        if '?' not in key:
-            raise ValueError('conditional must be of form ${condition?result:alternative}')
-        condition, rest = key.split('?', 1)
-        if ':' not in rest:
-            raise ValueError('conditional must be of form ${condition?result:alternative}')
-        primary, alternative = rest.split(':', 1)
-        condition, primary, alternative = [x.strip() for x in [condition, primary, alternative]]
+    def expandconditional(self, condition, primary, alternative):
         try:
             conditionvalue = self.expand(condition)
         except KeyError:
@@ -435,6 +1703,15 @@ class EnvironmentExpander(object):
             return self.expand(primary)
         return self.expand(alternative)
 
+class ResolvedExpander(EnvironmentExpander):
+    '''
+    Expander for values that have already been expanded, e.g. loaded from a
+    saved resolution. They are returned exactly as they are.
+    '''
+    def __init__(self, values):
+        EnvironmentExpander.__init__(self, values)
+        self.cache = values
+
 class Archive(object):
     def extract(self, local_path, strip_dirs=0):
         # The general idea is to mutate the in-memory archive, changing the
@@ -444,21 +1721,24 @@ class Archive(object):
         # like version-number, which forces us to change assembly references
         # in every project for every minor change.
         infolist = self.getinfolist()
-        goodentries=[]
-        for entry in infolist:
-            path_fragments = self.getentryname(entry).split('/')
-            isgood = len(path_fragments) > strip_dirs
-            isdir = self.isdir(entry)
-            if isgood:
-                path_fragments = path_fragments[strip_dirs:]
-                if path_fragments == ['']:
-                    continue
-                filename = '/'.join(path_fragments)
-                self.setentryname(entry, filename)
-                goodentries.append(entry)
-            if (not isdir) and (not isgood):
-                raise ValueError('Attempted to strip more leading directories than contained in archive file:{0}, strip:{1}'.format(self.getentryname(entry), strip_dirs))
+        goodentries = [entry for entry in infolist if self.strip_entry(entry, strip_dirs)]
         self.extract_many(goodentries, local_path)
+    def strip_entry(self, entry, strip_dirs):
+        '''
+        Remove strip_dirs leading directories from the name of entry.
+        Returns False if nothing is left of the entry and it should be
+        skipped.
+        '''
+        path_fragments = self.getentryname(entry).split('/')
+        if len(path_fragments) > strip_dirs:
+            path_fragments = path_fragments[strip_dirs:]
+            if path_fragments == ['']:
+                return False
+            self.setentryname(entry, '/'.join(path_fragments))
+            return True
+        if not self.isdir(entry):
+            raise ValueError('Attempted to strip more leading directories than contained in archive file:{0}, strip:{1}'.format(self.getentryname(entry), strip_dirs))
+        return False
     def extract_files(self, entries, local_path):
         for entry in entries:
             if not self.isdir(entry):
@@ -469,7 +1749,13 @@ class Archive(object):
                 self.extractentry(entry, local_path)
 
 class ZipArchive(Archive):
-    def __init__(self, file):
+    # Archives with at least this many members are extracted by several
+    # threads, if the archive is on disk where each can open its own handle.
+    PARALLEL_EXTRACT_MIN_ENTRIES = 64
+    def __init__(self, file, path=None, delete_path=False):
+        self.file = file
+        self.path = path
+        self.delete_path = delete_path
         self.zf = zipfile.ZipFile(file, "r")
     def getinfolist(self):
         return self.zf.infolist()
@@ -481,7 +1767,28 @@ class ZipArchive(Archive):
         # Extract the directories first, as zipfile doesn't create
         # them on demand.
         self.extract_directories(entries, localpath)
-        self.extract_files(entries, localpath)
+        jobs = int(get_config('extract-jobs', 4))
+        if self.path is None or jobs <= 1 or len(entries) < self.PARALLEL_EXTRACT_MIN_ENTRIES:
+            self.extract_files(entries, localpath)
+            return
+        # Complete the directory skeleton, so that the workers never race
+        # each other to create a directory.
+        files = [entry for entry in entries if not self.isdir(entry)]
+        for directory in set(os.path.dirname(os.path.join(localpath, entry.filename)) for entry in files):
+            ensure_directory(directory)
+        handles = threading.local()
+        archives = []
+        def extract_one(entry):
+            # Each worker reads through its own handle on the archive.
+            if not hasattr(handles, 'archive'):
+                handles.archive = ZipArchive(open(self.path, 'rb'))
+                archives.append(handles.archive)
+            handles.archive.extractentry(entry, localpath)
+        try:
+            parallel_map(extract_one, files, jobs)
+        finally:
+            for archive in archives:
+                archive.close()
     def extractentry(self, entry, localpath):
         permission_bits = entry.external_attr >> 16
         is_dir = stat.S_ISDIR(permission_bits)
@@ -513,6 +1820,9 @@ class ZipArchive(Archive):
         return entry.filename.endswith('/')
     def close(self):
         self.zf.close()
+        self.file.close()
+        if self.delete_path:
+            os.remove(self.path)
 
 class TarArchive(Archive):
     def __init__(self, name, fileobj):
@@ -535,82 +1845,873 @@ class TarArchive(Archive):
     def close(self):
         self.tf.close()
 
+class TarStreamArchive(TarArchive):
+    '''
+    A tar archive read in a single pass from a stream, such as an HTTP
+    response. Members are renamed and extracted as they arrive, so the
+    archive is never held in memory.
+    '''
+    def __init__(self, name, fileobj):
+        self.tf = tarfile.open(name=name, fileobj=fileobj, mode="r|*")
+    def extract(self, local_path, strip_dirs=0):
+        # Directories carry no data, so they can still be extracted at the
+        # end to update their attributes, as TarArchive does.
+        directories = []
+        for entry in self.tf:
+            if not self.strip_entry(entry, strip_dirs):
+                continue
+            if self.isdir(entry):
+                directories.append(entry)
+            else:
+                self.extractentry(entry, local_path)
+        self.extract_directories(directories, local_path)
+
+class NativeTarArchive(object):
+    '''
+    A tar archive unpacked in a single pass by piping it through the
+    system's tar. Gzipped archives are inflated by pigz, on several
+    threads, if it is installed. Data is read from fileobj as tar
+    consumes it, so a digest can still be taken on the way through.
+    '''
+    def __init__(self, name, fileobj, compression):
+        self.name = name
+        self.fileobj = fileobj
+        self.compression = compression
+    def extract(self, local_path, strip_dirs=0):
+        tar_args = ['tar', '-x', '-p', '--no-same-owner', '-f', '-', '-C', local_path]
+        if strip_dirs:
+            tar_args.append('--strip-components={0}'.format(strip_dirs))
+        # Otherwise tar inherits our end of pigz's input, and pigz never
+        # sees it end. Python 2 can't close them on Windows.
+        close_fds = platform.system() != 'Windows'
+        stderr = tempfile.TemporaryFile()
+        processes = []
+        try:
+            if self.compression == '-z' and native_program('pigz'):
+                processes.append(subprocess.Popen(['pigz', '-d', '-c'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr, close_fds=close_fds))
+                processes.append(subprocess.Popen(tar_args, stdin=processes[0].stdout, stderr=stderr, close_fds=close_fds))
+                processes[0].stdout.close()
+            else:
+                if self.compression:
+                    tar_args.insert(1, self.compression)
+                processes.append(subprocess.Popen(tar_args, stdin=subprocess.PIPE, stderr=stderr, close_fds=close_fds))
+            pipe = processes[0].stdin
+            try:
+                for chunk in iter(lambda: self.fileobj.read(COPY_BUFFER_SIZE), ''):
+                    try:
+                        pipe.write(chunk)
+                    except IOError:
+                        # tar gave up. Its exit status says why.
+                        break
+            except:
+                for process in processes:
+                    process.kill()
+                raise
+            finally:
+                pipe.close()
+                codes = [process.wait() for process in processes]
+            if any(codes):
+                stderr.seek(0)
+                raise IOError("tar failed to unpack '{0}': {1}".format(self.name, stderr.read().strip()))
+        finally:
+            stderr.close()
+    def close(self):
+        pass
+
+class NativeZipArchive(ZipArchive):
+    '''
+    A zip archive on disk, unpacked by the system's unzip. If that fails,
+    whatever it unpacked is removed, and zipfile is used instead.
+    '''
+    def extract(self, local_path, strip_dirs=0):
+        if self.path is not None:
+            target = tempfile.mkdtemp(prefix='.unzip', dir=local_path) if strip_dirs else local_path
+            with tempfile.TemporaryFile() as output:
+                # Exit status 1 is for warnings, such as skipping an unsafe
+                # member name, which zipfile would quietly rewrite.
+                code = subprocess.call(['unzip', '-q', '-o', self.path, '-d', target], stdout=output, stderr=output)
+            if code <= 1:
+                self.reset_modes(target)
+                if strip_dirs:
+                    move_stripped(target, local_path, strip_dirs)
+                    shutil.rmtree(target)
+                return
+            for name in os.listdir(local_path):
+                path = os.path.join(local_path, name)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+        ZipArchive.extract(self, local_path, strip_dirs)
+    def reset_modes(self, root):
+        # unzip applies the permissions stored in the archive, but zipfile
+        # ignores them, and both should produce the same tree. Find the
+        # modes zipfile would have used by making a file and a directory.
+        probe = os.path.join(root, '.unzip-probe')
+        os.mkdir(probe)
+        open(probe + '/file', 'w').close()
+        dir_mode = stat.S_IMODE(os.stat(probe).st_mode)
+        file_mode = stat.S_IMODE(os.stat(probe + '/file').st_mode)
+        shutil.rmtree(probe)
+        for dirpath, dirnames, filenames in os.walk(root):
+            for name, mode in [(d, dir_mode) for d in dirnames] + [(f, file_mode) for f in filenames]:
+                path = os.path.join(dirpath, name)
+                if not os.path.islink(path) and stat.S_IMODE(os.stat(path).st_mode) != mode:
+                    os.chmod(path, mode)
+
+def move_stripped(source, target, strip_dirs):
+    '''
+    Move what is strip_dirs directories down in source into target,
+    merging directories with the same name, as if it had been unpacked
+    there with strip_dirs leading directories removed.
+    '''
+    level = [source]
+    for depth in range(strip_dirs):
+        children = []
+        for directory in level:
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if not os.path.isdir(path) or os.path.islink(path):
+                    raise ValueError('Attempted to strip more leading directories than contained in archive file:{0}, strip:{1}'.format(
+                            os.path.relpath(path, source).replace(os.path.sep, '/'), strip_dirs))
+                children.append(path)
+        level = children
+    for directory in level:
+        merge_directory(directory, target)
+
+def merge_directory(source, target):
+    for name in os.listdir(source):
+        path = os.path.join(source, name)
+        target_path = os.path.join(target, name)
+        if os.path.isdir(target_path) and not os.path.islink(target_path) and os.path.isdir(path) and not os.path.islink(path):
+            merge_directory(path, target_path)
+            continue
+        if os.path.isdir(target_path) and not os.path.islink(target_path):
+            shutil.rmtree(target_path)
+        elif os.path.lexists(target_path):
+            os.remove(target_path)
+        os.rename(path, target_path)
+
+# Archives are unpacked by tarfile and zipfile unless 'extract-backend' is
+# set to 'native', in which case the system's tar (with pigz for gzip, on
+# several cores) and unzip are used where they are installed. Which is
+# faster depends on the machine: 'go bench-fetch --scenarios backends'
+# compares them.
+TAR_COMPRESSION_FLAGS = [('.tar.gz', '-z'), ('.tgz', '-z'), ('.tar.bz2', '-j'), ('.tbz2', '-j'), ('.tar.xz', '-J'), ('.tar', '')]
+
+_native_programs = {}
+
+def native_program(program):
+    # Whether program is installed, checked once per run.
+    if program not in _native_programs:
+        _native_programs[program] = program_exists(program)
+    return _native_programs[program]
+
+def native_extraction():
+    return get_config('extract-backend', 'python').lower() == 'native'
+
+def tar_compression(name):
+    '''
+    Returns the tar option for the compression of the archive name, ''
+    for none, or None if it isn't known to be a tar archive.
+    '''
+    for suffix, flag in TAR_COMPRESSION_FLAGS:
+        if name.lower().endswith(suffix):
+            return flag
+    return None
+
+def is_zip_name(name):
+    return os.path.splitext(name)[1].upper() in ['.ZIP', '.NUPKG', '.JAR']
+
+def file_path(fileobj):
+    '''
+    Returns the path of fileobj if it is a regular file on disk, which can
+    be read at random and opened again by path, or None if it is a stream
+    such as an HTTP response.
+    '''
+    name = getattr(fileobj, 'name', None)
+    if not isinstance(name, basestring):
+        return None
+    try:
+        st = os.fstat(fileobj.fileno())
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+    return name if stat.S_ISREG(st.st_mode) and os.path.isfile(name) else None
+
+def file_digest(path):
+    '''
+    Returns the SHA-256 and size of the file at path.
+    '''
+    with open(path, 'rb') as f:
+        hashing_file = HashingReader(f)
+        return hashing_file.drain(), hashing_file.size
+
 def openarchive(name, fileobj):
-    memoryfile = cStringIO.StringIO(fileobj.read())
-    if os.path.splitext(name)[1].upper() in ['.ZIP', '.NUPKG', '.JAR']:
-        return ZipArchive(memoryfile)
-    else:
-        return TarArchive(name, memoryfile)
+    native = native_extraction()
+    if is_zip_name(name):
+        zip_class = NativeZipArchive if native and native_program('unzip') else ZipArchive
+        path = file_path(fileobj)
+        if path is not None:
+            # Already on disk, so it is read in place, with no copy.
+            return zip_class(fileobj, path)
+        # unzip can only read it from disk.
+        spooled, path = spool(fileobj, 0 if zip_class is NativeZipArchive else None)
+        return zip_class(spooled, path, delete_path=path is not None)
+    compression = tar_compression(name)
+    if native and compression is not None and native_program('tar'):
+        return NativeTarArchive(name, fileobj, compression)
+    return TarStreamArchive(name, fileobj)
+
+# What reading a truncated or corrupt archive can raise, besides IOError.
+ARCHIVE_ERRORS = (tarfile.TarError, zipfile.BadZipfile, zlib.error, EOFError)
 
 def extract_archive(archive, local_path, strip_dirs=0):
     archive.extract(local_path, strip_dirs)
 
+class HashingReader(object):
+    '''
+    A file-like wrapper that computes the SHA-256 digest of everything
+    read through it.
+    '''
+    def __init__(self, fileobj, hash=None):
+        self.fileobj = fileobj
+        self.hash = hash or hashlib.sha256()
+        self.size = 0
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hash.update(data)
+        self.size += len(data)
+        return data
+    def drain(self):
+        # Read whatever the consumer left unread, e.g. the padding at the
+        # end of a tar file, and return the digest of the whole file.
+        while self.read(COPY_BUFFER_SIZE):
+            pass
+        return self.hash.hexdigest()
+    def close(self):
+        self.fileobj.close()
+
+# Each dest directory holds a manifest for every dependency unpacked into
+# it, recording where the archive came from and which files it installed.
+MANIFEST_DIRNAME = '.ohdevtools-manifests'
+STAGING_DIRNAME = '.ohdevtools-staging'
+
+def read_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def write_manifest(path, manifest):
+    ensure_directory(os.path.dirname(path))
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(path + '.tmp', path)
+
+def has_manifests(directory):
+    return os.path.isdir(os.path.join(directory, MANIFEST_DIRNAME))
+
+def untracked_files(directory):
+    '''
+    Returns the files in directory that no manifest there lists, e.g. ones
+    left by a fetch from before there were manifests, or put there by hand.
+    '''
+    tracked = set()
+    for manifest_path in glob(os.path.join(directory, MANIFEST_DIRNAME, '*.json')):
+        manifest = read_manifest(manifest_path)
+        if manifest is not None:
+            tracked.update(manifest['files'])
+    internal = (MANIFEST_DIRNAME + '/', STAGING_DIRNAME + '/')
+    return [f for f in list_tree(directory)[0] if f not in tracked and not f.startswith(internal)]
+
+def ensure_directory(path):
+    try:
+        os.makedirs(path)
+    except OSError:
+        # Either it already exists, possibly created by another thread in
+        # the meantime, or we'll find out what went wrong soon enough.
+        if not os.path.isdir(path):
+            raise
+
+def list_tree(root):
+    '''
+    Returns the files (including symlinks) and the directories under root,
+    as relative paths with '/' separators.
+    '''
+    files = []
+    directories = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        relative = os.path.relpath(dirpath, root).replace(os.path.sep, '/')
+        prefix = '' if relative == '.' else relative + '/'
+        for dirname in list(dirnames):
+            if os.path.islink(os.path.join(dirpath, dirname)):
+                dirnames.remove(dirname)
+                files.append(prefix + dirname)
+            else:
+                directories.append(prefix + dirname)
+        files.extend(prefix + filename for filename in filenames)
+    return files, directories
+
+def remove_path(path):
+    # A file in a manifest may since have been replaced by a directory.
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+def remove_empty_directories(root, relpaths):
+    # Deepest first, so that parents are empty by the time we reach them.
+    for relpath in sorted(relpaths, key=lambda p: p.count('/'), reverse=True):
+        try:
+            os.rmdir(os.path.join(root, relpath))
+        except OSError:
+            pass
+
+def files_owned_by_others(local_path, name):
+    '''
+    Returns the set of files in local_path that the manifests of
+    dependencies other than name say they installed.
+    '''
+    owned = set()
+    for manifest_path in glob(os.path.join(local_path, MANIFEST_DIRNAME, '*.json')):
+        manifest = read_manifest(manifest_path)
+        if manifest is not None and manifest['name'] != name:
+            owned.update(manifest['files'])
+    return owned
+
+def link_or_copy(source, target):
+    if os.path.islink(source):
+        os.symlink(os.readlink(source), target)
+        return
+    try:
+        os.link(source, target)
+    except OSError:
+        # Checked by DependencyStore.can_link_to, but e.g. the link count
+        # may be at its limit.
+        shutil.copy2(source, target)
+
+def make_read_only(path):
+    # Remove write permission from every file under path, but not from
+    # directories, so that the tree can still be deleted.
+    for directory, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            filepath = os.path.join(directory, filename)
+            mode = os.lstat(filepath).st_mode
+            if stat.S_ISREG(mode):
+                os.chmod(filepath, stat.S_IMODE(mode) & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+class DependencyStore(object):
+    '''
+    Unpacked dependency trees shared by every workspace of a user, keyed
+    by the SHA-256 of the archive and the number of directories stripped
+    from it. A tree found here is hard-linked into dest instead of being
+    unpacked again. This means dest and the store share files, so files
+    in the store are made read-only, and with them those under
+    dependencies/, so that nothing modifies them in place. Where dest
+    can't be linked to the store, trees are unpacked into dest as if
+    there were no store.
+
+    Each entry keeps a reference for every manifest that installed it,
+    written when the entry is added or looked up, before anything is
+    linked from it. collect_garbage removes entries that no manifest
+    refers to any more. These all hold a lock on the store, so that an
+    entry can't be collected between being found and being referenced.
+
+    The store is off unless 'shared-store' is set in config.json, since
+    it makes every file it installs read-only.
+    '''
+    # References younger than this are kept even if their manifest doesn't
+    # exist yet, since another process may be installing them right now.
+    GRACE_PERIOD = 24 * 60 * 60
+    def __init__(self, path):
+        self.path = path
+        ensure_directory(os.path.join(path, 'tmp'))
+        # Whether hard links work, by device of the directory linked into.
+        self.linkable = {}
+        self.linkable_lock = threading.Lock()
+    def can_link_to(self, directory):
+        '''
+        True if files in the store can be hard-linked into directory, which
+        is created if need be. Checked once for each filesystem.
+        '''
+        ensure_directory(directory)
+        device = os.stat(directory).st_dev
+        with self.linkable_lock:
+            if device not in self.linkable:
+                self.linkable[device] = self.probe_link(directory)
+            return self.linkable[device]
+    def probe_link(self, directory):
+        handle, source = tempfile.mkstemp(dir=os.path.join(self.path, 'tmp'))
+        os.close(handle)
+        target = os.path.join(directory, os.path.basename(source))
+        try:
+            os.link(source, target)
+        except OSError:
+            return False
+        else:
+            os.remove(target)
+            return True
+        finally:
+            os.remove(source)
+    def key(self, digest, strip_dirs):
+        return '{0}-strip{1}'.format(digest, strip_dirs)
+    def lookup(self, digest, strip_dirs):
+        tree = os.path.join(self.path, self.key(digest, strip_dirs), 'tree')
+        return tree if os.path.isdir(tree) else None
+    def lock(self):
+        return FileLock(os.path.join(self.path, 'lock'))
+    def use(self, digest, strip_dirs, manifest_path):
+        '''
+        Returns the tree for digest and strip_dirs, now referenced by
+        manifest_path, or None if there is none.
+        '''
+        with self.lock():
+            tree = self.lookup(digest, strip_dirs)
+            if tree is not None:
+                self.add_reference(os.path.dirname(tree), manifest_path)
+        return tree
+    def new_staging(self):
+        # Stage inside the store, so that a finished tree can be renamed in.
+        return tempfile.mkdtemp(dir=os.path.join(self.path, 'tmp'))
+    def add(self, staging_path, digest, strip_dirs, manifest_path):
+        '''
+        Move a tree unpacked into staging_path/tree into the store,
+        referenced by manifest_path, and return its new location.
+        '''
+        entry = os.path.join(self.path, self.key(digest, strip_dirs))
+        make_read_only(os.path.join(staging_path, 'tree'))
+        self.add_reference(staging_path, manifest_path)
+        with self.lock():
+            try:
+                os.rename(staging_path, entry)
+                staging_path = None
+            except OSError:
+                # Another process got there first with the same tree.
+                if not os.path.isdir(entry):
+                    raise
+                self.add_reference(entry, manifest_path)
+        if staging_path is not None:
+            shutil.rmtree(staging_path, ignore_errors=True)
+        return os.path.join(entry, 'tree')
+    def add_reference(self, entry, manifest_path):
+        refs = os.path.join(entry, 'refs')
+        ensure_directory(refs)
+        with open(os.path.join(refs, hashlib.md5(manifest_path).hexdigest()), 'w') as f:
+            f.write(manifest_path)
+    def collect_garbage(self):
+        '''
+        Remove entries with no live references, and abandoned staging
+        directories. Returns the number of entries removed.
+        '''
+        removed = 0
+        now = time.time()
+        for staging_path in glob(os.path.join(self.path, 'tmp', '*')):
+            if now - os.path.getmtime(staging_path) > self.GRACE_PERIOD:
+                shutil.rmtree(staging_path, ignore_errors=True)
+        for entry in glob(os.path.join(self.path, '*-strip*')):
+            key = os.path.basename(entry)
+            live = False
+            with self.lock():
+                for ref in glob(os.path.join(entry, 'refs', '*')):
+                    with open(ref) as f:
+                        manifest = read_manifest(f.read())
+                    if (manifest is not None and manifest.get('store-key') == key) or now - os.path.getmtime(ref) < self.GRACE_PERIOD:
+                        live = True
+                    else:
+                        os.remove(ref)
+                if not live:
+                    # Out of the way, so that it can be deleted without the
+                    # lock.
+                    trash_path = self.new_staging()
+                    os.rename(entry, os.path.join(trash_path, 'entry'))
+            if not live:
+                shutil.rmtree(trash_path, ignore_errors=True)
+                removed += 1
+        return removed
+
+def make_default_store():
+    # Off by default, since it makes installed files read-only, which
+    # breaks builds that patch their dependencies in place.
+    if not is_trueish(get_config('shared-store', False)):
+        return None
+    if not hasattr(os, 'link'):
+        # Python 2 on Windows. Every tree would be unpacked into the store
+        # and then copied, which is twice the work and the disk space.
+        return None
+    return DependencyStore(get_data_dir() + '/store')
+
+def uninstall(local_path, manifest):
+    # Files that another dependency also installed are left alone.
+    owned = files_owned_by_others(local_path, manifest['name'])
+    for relpath in manifest['files']:
+        path = os.path.join(local_path, relpath)
+        if relpath not in owned and os.path.lexists(path):
+            remove_path(path)
+    remove_empty_directories(local_path, manifest['directories'])
+
 
 class Dependency(object):
-    def __init__(self, name, environment, fetcher, logfile=None, has_overrides=False):
-        self.expander = EnvironmentExpander(environment)
+    def __init__(self, name, environment, fetcher, logfile=None, has_overrides=False, store=None):
+        if isinstance(environment, EnvironmentExpander):
+            self.expander = environment
+        else:
+            self.expander = EnvironmentExpander(environment)
         self.logfile = default_log(logfile)
         self.has_overrides = has_overrides
         self.fetcher = fetcher
-    def fetch(self):
+        self.store = store
+        self.report = None
+    def fetch(self, logfile=None, install_lock=None, force=False):
+        '''
+        Download and unpack the dependency, unless the manifest left by the
+        last fetch shows that it is already in place. The archive is
+        unpacked into a staging directory and only then swapped into dest.
+        With a shared store, an archive already unpacked for another
+        workspace is linked in from there instead. Returns True on success.
+        What happened, with sizes and timings, is left in self.report.
+        logfile:
+            Overrides the dependency's own log, e.g. to buffer output.
+        install_lock:
+            Held while swapping files into dest, which may be shared.
+        force:
+            Fetch even if the dependency is up to date.
+        '''
+        started = time.time()
+        self.report = {
+            'name': self.name,
+            'url': None,
+            'outcome': None,
+            'bytes': 0,
+            'bytes-downloaded': 0,
+            'time-to-first-byte': None,
+            'download-seconds': None,
+            'extract-seconds': None,
+            'files': None,
+            'seconds': None,
+            }
+        ok = False
+        try:
+            ok = self._fetch(logfile, install_lock, force, self.report)
+        finally:
+            self.report['seconds'] = time.time() - started
+            if not ok:
+                self.report['outcome'] = 'failed'
+            downloaded, seconds = self.report['bytes-downloaded'], self.report['download-seconds']
+            self.report['throughput'] = downloaded / seconds if downloaded and seconds else None
+        return ok
+    def _fetch(self, logfile, install_lock, force, report):
+        log = self.logfile if logfile is None else logfile
         remote_path = self.expander.expand('archive-path')
         local_path = os.path.abspath(self.expander.expand('dest'))
         strip_dirs = self.expander.expand('strip-archive-dirs')
         allow_cache = self.expander.expand('allow-cache')
-        self.logfile.write("Fetching '%s'\n  from '%s'" % (self.name, remote_path))
+        sha256 = self.expected_digest()
+        report['url'] = remote_path
+        if not force and self.is_up_to_date():
+            log.write("Fetching '%s'\n  from '%s' (up to date)\n" % (self.name, remote_path))
+            report['outcome'] = 'up-to-date'
+            return True
+        log.write("Fetching '%s'\n  from '%s'" % (self.name, remote_path))
+        tree = None
+        store = self.store if self.store is not None and self.store.can_link_to(local_path) else None
+        if store is not None and sha256 is not None:
+            # A pinned digest identifies the content, wherever it came from.
+            tree = store.use(sha256, strip_dirs, self.manifest_path())
+        digest = sha256
+        remote_file = hashing_file = on_disk = None
         try:
-            remote_file, method = self.fetcher.fetch(remote_path, allow_cache)
-            self.logfile.write(" (" + method + ")\n")
-            #opener = get_opener_for_path(remote_path)
-            #remote_file = opener(remote_path)
-            archive = openarchive(name=remote_path, fileobj=remote_file)
-        except IOError:
-            self.logfile.write("\n  FAILED\n")
+            if tree is None:
+                deltas = 'delta-updates' in self and self['delta-updates']
+                remote_file, method = self.fetcher.fetch(remote_path, allow_cache, sha256, self.mirror_paths(remote_path), deltas)
+                log.write(" (" + method + ")\n")
+                report['outcome'] = method
+                report.update(self.fetcher.pop_transfer(remote_path))
+                #opener = get_opener_for_path(remote_path)
+                #remote_file = opener(remote_path)
+                # The index only describes what's in the cache, which isn't
+                # what was downloaded unless it was read from there.
+                digest = self.fetcher.cached_digest(remote_path) if method in ['cache', 'delta'] else None
+                if sha256 is not None and digest != sha256:
+                    # Not known to match. It's checked while it's unpacked.
+                    digest = None
+                if store is not None and digest is not None:
+                    tree = store.use(digest, strip_dirs, self.manifest_path())
+            else:
+                log.write(" (stored)\n")
+            if tree is not None:
+                report['outcome'] = 'stored'
+            else:
+                # A zip file on disk, such as a local override or a cache
+                # entry, is unpacked in place and hashed separately, since
+                # hashing it on the way in would mean spooling a copy.
+                on_disk = file_path(remote_file) if is_zip_name(remote_path) else None
+                hashing_file = HashingReader(remote_file) if on_disk is None else None
+                archive = openarchive(name=remote_path, fileobj=hashing_file or remote_file)
+        except IOError as e:
+            log.write("\n  FAILED: %s\n" % (e,))
             return False
+        except ARCHIVE_ERRORS as e:
+            log.write("  FAILED: %s\n" % (self.unreadable_message(remote_path, e, sha256, hashing_file, on_disk),))
+            remote_file.close()
+            return False
+        if tree is not None:
+            if remote_file is not None:
+                remote_file.close()
+            log.write("  linking to '%s' (stored)\n" % (local_path,))
+        else:
+            if store is not None:
+                staging_path = store.new_staging()
+                tree = os.path.join(staging_path, 'tree')
+            else:
+                staging_path = tree = os.path.join(local_path, STAGING_DIRNAME, self.name)
+                if os.path.isdir(staging_path):
+                    shutil.rmtree(staging_path)
+            ensure_directory(tree)
+            log.write("  unpacking to '%s'\n" % (local_path,))
+            extract_started = time.time()
+            try:
+                extract_archive(archive, tree, strip_dirs)
+                report['extract-seconds'] = time.time() - extract_started
+                if hashing_file is not None:
+                    digest = hashing_file.drain()
+                    report['bytes'] = hashing_file.size
+                elif digest is None:
+                    digest, report['bytes'] = file_digest(on_disk)
+                else:
+                    # Recorded when it was downloaded into the cache.
+                    report['bytes'] = os.path.getsize(on_disk)
+                if report['outcome'] == 'web' and report['download-seconds'] is None:
+                    # Streamed straight from the network while unpacking.
+                    report['bytes-downloaded'] = report['bytes']
+                    report['download-seconds'] = report['extract-seconds']
+            except (IOError,) + ARCHIVE_ERRORS as e:
+                # Tar archives are read straight from the network while they
+                # are unpacked, so a dropped connection shows up here, as
+                # well as a corrupt archive.
+                log.write("  FAILED: %s\n" % (self.unreadable_message(remote_path, e, sha256, hashing_file, on_disk),))
+                shutil.rmtree(staging_path, ignore_errors=True)
+                return False
+            finally:
+                archive.close()
+                remote_file.close()
+            if sha256 is not None and digest != sha256:
+                # Nothing in dest has been touched yet.
+                log.write("  FAILED: %s\n" % (digest_mismatch_message(remote_path, digest, sha256),))
+                shutil.rmtree(staging_path, ignore_errors=True)
+                return False
+            if store is not None:
+                tree = store.add(staging_path, digest, strip_dirs, self.manifest_path())
+        files, directories = list_tree(tree)
+        report['files'] = len(files)
+        manifest = {
+            'name': self.name,
+            'archive-path': remote_path,
+            'strip-archive-dirs': strip_dirs,
+            'archive-sha256': digest,
+            'source-stamp': self.fetcher.stat(remote_path),
+            'files': files,
+            'directories': directories,
+            }
+        if store is not None:
+            manifest['store-key'] = store.key(digest, strip_dirs)
+        if install_lock is None:
+            self.install(tree, manifest)
+        else:
+            with install_lock:
+                self.install(tree, manifest)
+        log.write("  OK\n")
+        return True
+    def unreadable_message(self, remote_path, error, sha256, hashing_file, on_disk):
+        # If the digest is pinned, an archive that can't be unpacked is
+        # most likely not the one expected, which is the more useful thing
+        # to say.
+        if sha256 is not None:
+            try:
+                if hashing_file is not None:
+                    digest = hashing_file.drain()
+                else:
+                    digest = file_digest(on_disk)[0]
+            except (IOError, OSError):
+                digest = None
+            if digest is not None and digest != sha256:
+                return digest_mismatch_message(remote_path, digest, sha256)
+        if isinstance(error, ARCHIVE_ERRORS):
+            return "can't unpack '{0}': {1}".format(remote_path, error)
+        return str(error)
+    def manifest_path(self):
+        return os.path.join(os.path.abspath(self['dest']), MANIFEST_DIRNAME, self.name + '.json')
+    def read_manifest(self):
+        return read_manifest(self.manifest_path())
+    def is_up_to_date(self):
+        '''
+        True if the manifest shows that the same archive was unpacked in
+        the same way, and all of its files are still present. Local
+        archives are identified by path, size and modification time, and
+        those with a pinned digest by that. Other remote archives may be
+        republished at the same URL, so they are revalidated through the
+        cache, which costs one round trip if they haven't changed. Without
+        'allow-cache' there's no cheap way to tell, so they never count as
+        up to date.
+        '''
+        manifest = self.read_manifest()
+        if manifest is None:
+            return False
+        remote_path = self['archive-path']
+        if manifest['archive-path'] != remote_path or manifest['strip-archive-dirs'] != self['strip-archive-dirs']:
+            return False
+        if manifest['source-stamp'] != self.fetcher.stat(remote_path):
+            return False
+        sha256 = self.expected_digest()
+        if sha256 is not None and manifest['archive-sha256'] != sha256:
+            return False
+        local_path = os.path.abspath(self['dest'])
+        if not all(os.path.lexists(os.path.join(local_path, f)) for f in manifest['files']):
+            return False
+        if sha256 is None and self.fetcher.is_remote(remote_path):
+            if not self['allow-cache'] or self.revalidated_digest(remote_path) != manifest['archive-sha256']:
+                return False
+            # Nothing will be fetched, so nothing to report.
+            self.fetcher.pop_transfer(remote_path)
+        return True
+    def revalidated_digest(self, remote_path):
+        # The digest of remote_path's content, once the cache has checked
+        # it with the server, or None if it can't be fetched. If it has
+        # changed, it is downloaded into the cache now, ready to unpack.
+        deltas = 'delta-updates' in self and self['delta-updates']
+        try:
+            f = self.fetcher.fetch(remote_path, True, None, self.mirror_paths(remote_path), deltas)[0]
+        except (IOError, socket.error, httplib.HTTPException):
+            return None
+        f.close()
+        return self.fetcher.cached_digest(remote_path)
+    def install(self, tree, manifest):
+        # Swap the files in tree into dest in place of those listed in the
+        # old manifest. As in clean_directories, the old files are first
+        # moved aside, so that if one can't be moved (e.g. a DLL in use on
+        # Windows) everything is put back before anything is lost. Trees
+        # in the store are linked, and staged trees are moved.
+        local_path = os.path.abspath(self['dest'])
+        old_manifest = self.read_manifest() or {'files':[], 'directories':[]}
+        owned = files_owned_by_others(local_path, self.name)
+        trash_path = os.path.join(local_path, STAGING_DIRNAME, self.name + '.old')
+        moved = []
         try:
-            os.makedirs(local_path)
+            for relpath in old_manifest['files']:
+                path = os.path.join(local_path, relpath)
+                if relpath not in owned and os.path.lexists(path):
+                    trash = os.path.join(trash_path, relpath)
+                    ensure_directory(os.path.dirname(trash))
+                    os.rename(path, trash)
+                    moved.append((path, trash))
         except OSError:
-            # We get an error if the directory exists, which we are happy to
-            # ignore. If something worse went wrong, we will find out very
-            # soon when we try to extract the files.
-            pass
-        self.logfile.write("  unpacking to '%s'\n" % (local_path,))
-        extract_archive(archive, local_path, strip_dirs)
-        archive.close()
-        remote_file.close()
-        self.logfile.write("  OK\n")
-        return True
+            for original, trash in reversed(moved):
+                os.rename(trash, original)
+            raise Exception("Failed to replace '{0}' in '{1}'. Try closing applications that might be using it. (E.g. Visual Studio.)".format(self.name, local_path))
+        for relpath in manifest['directories']:
+            ensure_directory(os.path.join(local_path, relpath))
+        for relpath in manifest['files']:
+            path = os.path.join(local_path, relpath)
+            ensure_directory(os.path.dirname(path))
+            if os.path.lexists(path):
+                # Left by another dependency, or by something else entirely,
+                # possibly an old directory of the same name.
+                remove_path(path)
+            if 'store-key' in manifest:
+                link_or_copy(os.path.join(tree, relpath), path)
+            else:
+                os.rename(os.path.join(tree, relpath), path)
+        remove_empty_directories(local_path, set(old_manifest['directories']) - set(manifest['directories']))
+        write_manifest(self.manifest_path(), manifest)
+        shutil.rmtree(trash_path, ignore_errors=True)
+        if 'store-key' not in manifest:
+            shutil.rmtree(tree, ignore_errors=True)
+        remove_empty_directories(local_path, [STAGING_DIRNAME])
+    def expected_digest(self):
+        '''
+        The SHA-256 the archive is pinned to by the optional 'sha256' key,
+        or None.
+        '''
+        if 'sha256' not in self:
+            return None
+        sha256 = self['sha256']
+        return sha256.strip().lower() if sha256 else None
+    def mirror_paths(self, remote_path):
+        '''
+        The URLs of remote_path on each of 'binary-mirrors', if it is under
+        'binary-repo'.
+        '''
+        if 'binary-mirrors' not in self or 'binary-repo' not in self:
+            return []
+        mirrors = self['binary-mirrors']
+        repo = (self['binary-repo'] or '').rstrip('/')
+        if not mirrors or not repo or not remote_path.startswith(repo + '/'):
+            return []
+        return [mirror.rstrip('/') + remote_path[len(repo):] for mirror in mirrors]
     @property
     def name(self):
         return self['name']
     def __getitem__(self, key):
-        return self.expander.expand(key)
+        return self.expander[key]
     def __contains__(self, key):
         return key in self.expander
     def items(self):
         return self.expander.items()
-    def checkout(self):
+    def checkout(self, logfile=None, mirrors=None):
+        '''
+        Clone or update the dependency's source-git repo in ../<name> and
+        check out its tag. A repo already at the tag is left alone, without
+        fetching anything. Returns True on success.
+        logfile:
+            Overrides the dependency's own log, e.g. to buffer output.
+        mirrors:
+            GitMirrors to borrow objects from when cloning.
+        The optional 'source-depth' key (or 'source-depth' setting) makes
+        shallow clones of that depth at the tag, and 'source-sparse-paths'
+        lists the only paths to check out.
+        '''
+        log = self.logfile if logfile is None else logfile
         name = self['name']
         sourcegit = self['source-git']
         if sourcegit is None:
-            self.logfile.write('No git repo defined for {0}.\n'.format(name))
+            log.write('No git repo defined for {0}.\n'.format(name))
             return False
-        self.logfile.write("Fetching source for '%s'\n  into '%s'\n" % (name, os.path.abspath('../'+name)))
+        log.write("Fetching source for '%s'\n  into '%s'\n" % (name, os.path.abspath('../'+name)))
         tag = self['tag']
+        depth = self['source-depth'] if 'source-depth' in self else get_config('source-depth')
+        sparse_paths = self['source-sparse-paths'] if 'source-sparse-paths' in self else None
         try:
             if not os.path.exists('../'+name):
-                self.logfile.write('  git clone {0} {1}\n'.format(sourcegit, name))
-                subprocess.check_call(['git', 'clone', sourcegit, name], cwd='..', shell=True)
+                args = ['clone']
+                mirror = mirrors.update(sourcegit, log) if mirrors is not None else None
+                if mirror is not None:
+                    # Objects come from the mirror and are copied, so the
+                    # clone doesn't depend on it afterwards.
+                    args += ['--reference', mirror, '--dissociate']
+                if depth:
+                    args += ['--depth', str(depth), '--branch', tag]
+                if sparse_paths:
+                    args += ['--no-checkout']
+                run_git(args + [sourcegit, name], '..', log)
+                if sparse_paths:
+                    run_git(['sparse-checkout', 'set'] + list(sparse_paths), '../'+name, log)
             elif not os.path.isdir('../'+name):
-                self.logfile.write('Cannot checkout {0}, because directory ../{0} already exists\n'.format(name))
+                log.write('Cannot checkout {0}, because directory ../{0} already exists\n'.format(name))
                 return False
             else:
-                self.logfile.write('  git fetch origin\n')
-                subprocess.check_call(['git', 'fetch', 'origin'], cwd='../'+name, shell=True)
-            self.logfile.write("  git checkout {0}\n".format(tag))
-            subprocess.check_call(['git', 'checkout', tag], cwd='../'+name, shell=True)
-        except subprocess.CalledProcessError as cpe:
-            self.logfile.write(str(cpe)+'\n')
+                head = git_revision('HEAD', '../'+name)
+                if head is not None and head == git_revision(tag, '../'+name):
+                    log.write("  already at {0}\n".format(tag))
+                    return True
+                if depth:
+                    run_git(['fetch', '--depth', str(depth), 'origin', 'tag', tag], '../'+name, log)
+                else:
+                    run_git(['fetch', 'origin'], '../'+name, log)
+            run_git(['checkout', tag], '../'+name, log)
+        except (subprocess.CalledProcessError, OSError) as cpe:
+            log.write(str(cpe)+'\n')
             return False
         return True
     def expand_remote_path(self):
@@ -618,76 +2719,324 @@ class Dependency(object):
     def expand_local_path(self):
         return self.expander.expand('dest')
     def expand_configure_args(self):
-        return self.expander.expand('configure-args')
+        return self.expander['configure-args']
 
 
 class DependencyCollection(object):
-    def __init__(self, env, logfile=None, fetcher=None):
+    def __init__(self, env, logfile=None, fetcher=None, store=None):
         if fetcher is None:
             fetcher = make_default_fetcher()
+        if store is None:
+            store = make_default_store()
         self.logfile = default_log(logfile)
         self.base_env = env
         self.dependency_types = DEPENDENCY_TYPES
+        self.type_environments = {}
+        self.definitions = {}
         self.dependencies = {}
+        self.report = None
         self.fetcher = fetcher
+        self.store = store
+        self.log_lock = threading.Lock()
     def create_dependency(self, dependency_definition, overrides={}):
+        '''
+        Add a dependency definition to the collection. The Dependency itself
+        is only created, and its values expanded, when it is first asked for.
+        '''
         defn = dependency_definition
-        env = {}
-        env.update(self.base_env)
-        if 'type' in defn:
-            dep_type = defn['type']
-            env.update(self.dependency_types[dep_type])
-        else:
-            # default to an 'external' dependency type if none specified
-            dep_type = 'external'
-            env.update(self.dependency_types[dep_type])
-        env.update(defn)
-        env.update(overrides)
+        # default to an 'external' dependency type if none specified
+        dep_type = defn.get('type', 'external')
+        if dep_type not in self.type_environments:
+            self.type_environments[dep_type] = LayeredEnvironment(self.base_env, self.dependency_types[dep_type])
+        env = LayeredEnvironment(self.type_environments[dep_type], defn, overrides)
         if 'name' not in env:
             raise ValueError('Dependency definition contains no name')
-        name = env['name']
-        new_dependency = Dependency(name, env, self.fetcher, logfile=self.logfile, has_overrides=len(overrides) > 0)
-        if 'ignore' in new_dependency and new_dependency['ignore']:
+        # Entries of the 'ignore' type are only comments, so are turned
+        # away on their raw value, before anything needs expanding.
+        if env.get('ignore', False) and not isinstance(env['ignore'], basestring):
             return
-        self.dependencies[name] = new_dependency
+        name = env['name']
+        self.definitions[name] = (env, len(overrides) > 0)
+        self.dependencies.pop(name, None)
+    def _materialize(self, name):
+        '''
+        Returns the Dependency called name, creating it from its definition
+        if this is the first time it has been asked for, or None if it turns
+        out to be ignored.
+        '''
+        if name not in self.dependencies:
+            env, has_overrides = self.definitions[name]
+            expander = EnvironmentExpander(env)
+            if 'ignore' in env and expander['ignore']:
+                self.dependencies[name] = None
+            else:
+                self.dependencies[name] = Dependency(name, expander, self.fetcher, logfile=self.logfile, has_overrides=has_overrides, store=self.store)
+        return self.dependencies[name]
+    def add_resolved(self, name, values, has_overrides=False):
+        '''
+        Add a dependency whose values have already been expanded.
+        '''
+        self.definitions[name] = (None, has_overrides)
+        self.dependencies[name] = Dependency(name, ResolvedExpander(values), self.fetcher, logfile=self.logfile, has_overrides=has_overrides, store=self.store)
+    def resolve(self, subset=None):
+        '''
+        Expand RESOLVED_KEYS for the dependencies in subset, or for every
+        dependency, for save_resolution(). Returns a resolution: the
+        expanded values, the names of overridden dependencies, the names
+        covered (ignored ones included), whether that is all of them, and
+        the values of the base environment the expansions depended on, with
+        None for keys that were looked for but not defined. Returns None if
+        a dependency isn't defined or can't be expanded.
+        '''
+        names = sorted(set(self.definitions.keys() if subset is None else subset))
+        dependencies = {}
+        overridden = []
+        env = {}
+        for name in names:
+            if name not in self.definitions:
+                return None
+            layered_env = self.definitions[name][0]
+            if layered_env is None:
+                return None
+            for key in self._keys_used(layered_env):
+                layer = layered_env.defining_layer(key)
+                if layer is None or layer is self.base_env:
+                    env[key] = self.base_env.get(key)
+            try:
+                dependency = self._materialize(name)
+            except Exception:
+                return None
+            if dependency is None:
+                continue
+            values = {}
+            for key in RESOLVED_KEYS:
+                try:
+                    values[key] = dependency[key]
+                except KeyError:
+                    pass
+                except Exception:
+                    return None
+            dependencies[name] = values
+            if dependency.has_overrides:
+                overridden.append(name)
+        complete = set(names) >= set(self.definitions.keys())
+        return {'env': env, 'dependencies': dependencies, 'overridden': overridden, 'names': names, 'complete': complete}
+    def _keys_used(self, layered_env):
+        # Everything reachable from the resolved keys by references, taking
+        # both branches of every conditional.
+        edges = layered_env.reference_edges()
+        used = set()
+        pending = list(RESOLVED_KEYS) + ['ignore']
+        while pending:
+            key = pending.pop()
+            if key not in used:
+                used.add(key)
+                pending.extend(edges.get(key, ()))
+        return used
     def __contains__(self, key):
-        return key in self.dependencies
+        return key in self.definitions and self._materialize(key) is not None
     def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
         return self.dependencies[key]
     def items(self):
-        return self.dependencies.items()
+        return [(name, self[name]) for name in self.definitions.keys() if name in self]
     def _filter(self, subset=None):
         if subset is None:
-            return self.dependencies.values()
-        missing_dependencies = [name for name in subset if name not in self.dependencies]
+            return [dependency for (name, dependency) in self.items()]
+        missing_dependencies = [name for name in subset if name not in self]
         if len(missing_dependencies) > 0:
             raise Exception("No entries in dependency file named: " + ", ".join(missing_dependencies) + ".")
-        return [self.dependencies[name] for name in subset]
+        return [self[name] for name in subset]
     def get_args(self, subset=None):
         dependencies = self._filter(subset)
         configure_args=sum((d.expand_configure_args() for d in dependencies), [])
         return configure_args
-    def fetch(self, subset=None):
+    def fetch(self, subset=None, jobs=1, force=False):
+        '''
+        Fetch the dependencies in subset, or all of them. Returns True if
+        they all succeeded. A report of what each fetch did is left in
+        self.report, and summarized in the log.
+        '''
         dependencies = self._filter(subset)
-        failed_dependencies = []
-        for d in dependencies:
-            if not d.fetch():
-                failed_dependencies.append(d.name)
+        started = time.time()
+        self.fetcher.set_concurrency(jobs)
+        if jobs is None or jobs <= 1:
+            results = [d.fetch(force=force) for d in dependencies]
+        else:
+            # Downloads and extraction into staging directories overlap, but
+            # dependencies sharing a dest are swapped into it one at a time.
+            install_locks = {}
+            for d in dependencies:
+                install_locks.setdefault(os.path.normcase(os.path.abspath(d['dest'])), threading.Lock())
+            def fetch_one(d, logfile):
+                return d.fetch(logfile=logfile, install_lock=install_locks[os.path.normcase(os.path.abspath(d['dest']))], force=force)
+            results = self._run_buffered(fetch_one, dependencies, jobs)
+        self.report = {
+            'seconds': time.time() - started,
+            'jobs': jobs,
+            'dependencies': [d.report for d in dependencies],
+            }
+        self.logfile.write(summarize_fetch_report(self.report))
+        failed_dependencies = [d.name for (d, ok) in zip(dependencies, results) if not ok]
         if failed_dependencies:
             self.logfile.write("Failed to fetch some dependencies: " + ' '.join(failed_dependencies) + '\n')
             return False
         return True
-    def checkout(self, subset=None):
+    def remove_stale(self, directories, subset=None):
+        '''
+        Uninstall anything with a manifest in one of directories that is
+        not among the dependencies in subset, or that now has a different
+        dest.
+        '''
+        current = dict((d.name, os.path.normcase(os.path.abspath(d['dest']))) for d in self._filter(subset))
+        for directory in directories:
+            local_path = os.path.normcase(os.path.abspath(directory))
+            for manifest_path in glob(os.path.join(directory, MANIFEST_DIRNAME, '*.json')):
+                manifest = read_manifest(manifest_path)
+                if manifest is not None and current.get(manifest['name']) == local_path:
+                    continue
+                if manifest is not None:
+                    self.logfile.write("Removing '%s'\n  from '%s'\n" % (manifest['name'], local_path))
+                    uninstall(local_path, manifest)
+                os.remove(manifest_path)
+    def _run_buffered(self, function, dependencies, jobs):
+        '''
+        Call function(dependency, logfile) for each of dependencies, up to
+        jobs at once, and return the results. Each dependency's log output
+        is buffered and written out in one piece when it finishes, so that
+        the logs don't interleave.
+        '''
+        def run_one(d):
+            buffered_log = StringIO.StringIO()
+            try:
+                return function(d, buffered_log)
+            finally:
+                with self.log_lock:
+                    self.logfile.write(buffered_log.getvalue())
+                    self.logfile.flush()
+        return parallel_map(run_one, dependencies, jobs)
+    def checkout(self, subset=None, jobs=1):
         dependencies = self._filter(subset)
-        failed_dependencies = []
-        for d in dependencies:
-            if not d.checkout():
-                failed_dependencies.append(d.name)
+        mirrors = default_git_mirrors()
+        if jobs is None or jobs <= 1:
+            results = [d.checkout(mirrors=mirrors) for d in dependencies]
+        else:
+            results = self._run_buffered(lambda d, logfile: d.checkout(logfile=logfile, mirrors=mirrors), dependencies, jobs)
+        failed_dependencies = [d.name for (d, ok) in zip(dependencies, results) if not ok]
         if failed_dependencies:
             self.logfile.write("Failed to check out some dependencies: " + ' '.join(failed_dependencies) + '\n')
             return False
         return True
 
+def format_size(size):
+    for suffix in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024 or suffix == 'GB':
+            break
+        size /= 1024.0
+    return "{0:.1f}{1}".format(size, suffix) if suffix != 'B' else "{0}B".format(size)
+
+def summarize_fetch_report(report):
+    '''
+    A few lines for the log about the fetch described by report: outcomes,
+    the total downloaded and the dependencies that took longest.
+    '''
+    dependencies = report['dependencies']
+    outcomes = {}
+    for d in dependencies:
+        outcomes[d['outcome']] = outcomes.get(d['outcome'], 0) + 1
+    downloaded = sum(d['bytes-downloaded'] for d in dependencies)
+    lines = ["Fetched {0} dependencies in {1:.1f}s: {2}".format(
+            len(dependencies), report['seconds'],
+            ', '.join('{0} {1}'.format(count, outcome) for (outcome, count) in sorted(outcomes.items())))]
+    if downloaded:
+        download_seconds = sum(d['download-seconds'] or 0 for d in dependencies)
+        lines.append("  downloaded {0}{1}".format(format_size(downloaded),
+                " at {0}/s".format(format_size(downloaded / download_seconds)) if download_seconds else ""))
+    slowest = sorted((d for d in dependencies if d['outcome'] != 'up-to-date'), key=lambda d: -d['seconds'])[:3]
+    for d in slowest:
+        lines.append("  {0:.1f}s '{1}' ({2}, {3}{4})".format(
+                d['seconds'], d['name'], d['outcome'], format_size(d['bytes']),
+                ", {0} files".format(d['files']) if d['files'] is not None else ""))
+    return ''.join(line + '\n' for line in lines)
+
+def write_fetch_report(path, report):
+    ensure_directory(os.path.dirname(os.path.abspath(path)))
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+
+def run_git(args, cwd, logfile):
+    '''
+    Run git with args in cwd, writing the command and its output to logfile.
+    Raises CalledProcessError if it fails.
+    '''
+    logfile.write('  git {0}\n'.format(' '.join(args)))
+    process = subprocess.Popen(['git'] + args, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    for line in output.splitlines():
+        logfile.write(('    ' + line).rstrip() + '\n')
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, ['git'] + args)
+
+def git_revision(revision, cwd):
+    '''
+    Returns the commit that revision names in the repo in cwd, or None if
+    there isn't one. Only looks at the local repo.
+    '''
+    try:
+        process = subprocess.Popen(['git', 'rev-parse', '--verify', '--quiet', revision + '^{commit}'], cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        return None
+    output = process.communicate()[0].strip()
+    if process.returncode != 0 or not output:
+        return None
+    return output
+
+class GitMirrors(object):
+    '''
+    Bare mirrors of source repos, shared by every workspace, that clones
+    borrow objects from instead of downloading them again. Each mirror is
+    fetched at most once per run.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.repo_locks = {}
+        self.updated = {}
+    def mirror_path(self, url):
+        name = re.sub(r'[^\w.-]', '_', re.split(r'[/:\\]', url.rstrip('/'))[-1])
+        return os.path.join(self.path, hashlib.md5(url).hexdigest()[:12] + '-' + name)
+    def update(self, url, logfile):
+        '''
+        Create or refresh the mirror of url. Returns its path, or None if
+        it couldn't be brought up to date.
+        '''
+        with self.lock:
+            repo_lock = self.repo_locks.setdefault(url, threading.Lock())
+        with repo_lock:
+            if url not in self.updated:
+                path = self.mirror_path(url)
+                try:
+                    if os.path.isdir(path):
+                        run_git(['fetch', '--prune', 'origin'], path, logfile)
+                    else:
+                        ensure_directory(self.path)
+                        run_git(['clone', '--mirror', url, path], self.path, logfile)
+                except (subprocess.CalledProcessError, OSError) as e:
+                    logfile.write('  mirror not used: {0}\n'.format(e))
+                    path = None
+                self.updated[url] = path
+            return self.updated[url]
+
+_git_mirrors = None
+
+def default_git_mirrors():
+    # One instance for the whole run, so that each mirror is only fetched once.
+    global _git_mirrors
+    if _git_mirrors is None and is_trueish(get_config('git-mirrors', True)):
+        _git_mirrors = GitMirrors(get_data_dir() + '/git-mirrors')
+    return _git_mirrors
+
 def read_json_dependencies(dependencyfile, overridefile, env, logfile, fetcher=None):
     collection = DependencyCollection(env, logfile=logfile, fetcher=fetcher)
     dependencies = json.load(dependencyfile)
@@ -699,14 +3048,201 @@ def read_json_dependencies(dependencyfile, overridefile, env, logfile, fetcher=N
         collection.create_dependency(d, override)
     return collection
 
-def read_json_dependencies_from_filename(dependencies_filename, overrides_filename, env, logfile, fetcher=None):
-    dependencyfile = open(dependencies_filename, "r")
+def read_json_dependencies_from_filename(dependencies_filename, overrides_filename, env, logfile, fetcher=None, resolved=False, names=None):
+    '''
+    Read the dependencies and local overrides files.
+    resolved:
+        True to use a saved resolution of the files if there is one, from
+        the lockfile beside the dependencies file or the data directory, and
+        to save one otherwise. The dependencies then only have the keys in
+        RESOLVED_KEYS, but nothing needs to be expanded.
+    names:
+        With resolved, the dependencies that are going to be used, or None
+        for all of them. Only these need to be in the resolution, and only
+        these are expanded if there isn't one yet.
+    '''
     with open(dependencies_filename) as dependencyfile:
-        if overrides_filename is not None and os.path.isfile(overrides_filename):
-            with open(overrides_filename) as overridesfile:
-                return read_json_dependencies(dependencyfile, overridesfile, env, logfile, fetcher)
-        else:
-            return read_json_dependencies(dependencyfile, cStringIO.StringIO('[]'), env, logfile, fetcher)
+        dependency_data = dependencyfile.read()
+    override_data = '[]'
+    if overrides_filename is not None and os.path.isfile(overrides_filename):
+        with open(overrides_filename) as overridesfile:
+            override_data = overridesfile.read()
+    if not resolved:
+        return read_json_dependencies(cStringIO.StringIO(dependency_data), cStringIO.StringIO(override_data), env, logfile, fetcher)
+    key = resolution_key(dependency_data, override_data)
+    resolution = load_resolution(key, env, lockfile_path(dependencies_filename), names)
+    if resolution is not None:
+        collection = DependencyCollection(env, logfile=logfile, fetcher=fetcher)
+        overridden = set(resolution['overridden'])
+        for (name, values) in resolution['dependencies'].items():
+            collection.add_resolved(name, values, name in overridden)
+        return collection
+    collection = read_json_dependencies(cStringIO.StringIO(dependency_data), cStringIO.StringIO(override_data), env, logfile, fetcher)
+    resolution = collection.resolve(names)
+    if resolution is not None:
+        save_resolution(key, env, resolution)
+    return collection
+
+# The keys of each dependency that are saved in a resolution. They are all
+# that fetching and get_dependency_args need.
+RESOLVED_KEYS = ['name', 'archive-path', 'dest', 'configure-args', 'tag', 'strip-archive-dirs', 'allow-cache', 'sha256', 'binary-repo', 'binary-mirrors', 'delta-updates']
+RESOLUTION_FORMAT = 1
+# Saved resolutions kept per version of the dependency files, one for each
+# combination of platform, debug mode and so on.
+MAX_RESOLUTIONS = 16
+# Files kept in the resolution cache, one per version of the dependency
+# files. The least recently used are removed.
+MAX_RESOLUTION_FILES = 32
+
+def resolution_key(dependency_data, override_data):
+    '''
+    Hash of everything other than the environment that a resolution of the
+    dependency files depends on.
+    '''
+    sha = hashlib.sha256()
+    for part in [str(RESOLUTION_FORMAT), json.dumps(RESOLVED_KEYS), json.dumps(DEPENDENCY_TYPES, sort_keys=True), dependency_data, override_data]:
+        sha.update(part)
+        sha.update('\0')
+    return sha.hexdigest()
+
+def lockfile_path(dependencies_filename):
+    return os.path.splitext(dependencies_filename)[0] + '.lock.json'
+
+def resolution_cache_path(key):
+    return os.path.join(get_data_dir(), 'resolved', key + '.json')
+
+def resolution_matches(resolution, env):
+    '''
+    True if resolution was made with the same values in env for the keys it
+    depended on.
+    '''
+    return all(env.get(key) == value for (key, value) in resolution['env'].items())
+
+def resolution_names(resolution):
+    # Resolutions saved before they could cover a subset covered everything,
+    # and don't say so.
+    return set(resolution.get('names', resolution['dependencies'].keys()))
+
+def matching_resolution(resolutions, env, names=None):
+    '''
+    Returns the resolution that matches env and covers the dependencies in
+    names, or all of them if names is None, or None.
+    '''
+    for resolution in resolutions:
+        covered = resolution.get('complete', True) or (names is not None and set(names) <= resolution_names(resolution))
+        if covered and resolution_matches(resolution, env):
+            return resolution
+    return None
+
+def merge_resolution(resolutions, env, resolution):
+    '''
+    Returns resolutions with resolution added, merged with the ones that
+    match env, so that resolutions of different subsets add up. The merged
+    resolution depends on the keys all of them depended on, so the ones it
+    merged are only replaced if it doesn't depend on any more keys.
+    '''
+    merged = resolution
+    for older in resolutions:
+        if not resolution_matches(older, env):
+            continue
+        older_names = resolution_names(older) - set(merged['names'])
+        dependencies = dict(older['dependencies'])
+        dependencies.update(merged['dependencies'])
+        merged_env = dict(older['env'])
+        merged_env.update(merged['env'])
+        merged = {
+            'env': merged_env,
+            'dependencies': dependencies,
+            'overridden': sorted(set(merged['overridden']) | (set(older['overridden']) & older_names)),
+            'names': sorted(set(merged['names']) | older_names),
+            'complete': merged['complete'] or older.get('complete', True)}
+    others = [r for r in resolutions if r['env'] != merged['env']]
+    return [merged] + others[:MAX_RESOLUTIONS - 1]
+
+# Resolutions already loaded or made by this process, by key.
+_resolutions = {}
+
+def load_resolution(key, env, lockfile=None, names=None):
+    resolution = matching_resolution(_resolutions.get(key, []), env, names)
+    if resolution is not None:
+        return resolution
+    sources = [resolution_cache_path(key)]
+    if lockfile is not None:
+        sources.insert(0, lockfile)
+    for path in sources:
+        saved = read_manifest(path) if os.path.isfile(path) else None
+        if saved is None or saved.get('format') != RESOLUTION_FORMAT:
+            continue
+        resolutions = saved.get('resolutions', {}).get(key, [])
+        resolution = matching_resolution(resolutions, env, names)
+        if resolution is not None:
+            _resolutions[key] = merge_resolution(_resolutions.get(key, []), env, resolution)
+            if path != lockfile:
+                touch_resolution_cache(path)
+            return resolution
+    return None
+
+def add_resolution(path, key, env, resolution):
+    '''
+    Add resolution to the file at path, merged with any made for the same
+    environment. Resolutions for other keys, i.e. for other versions of the
+    dependency files, are dropped.
+    '''
+    saved = (read_manifest(path) if os.path.isfile(path) else None) or {}
+    resolutions = []
+    if saved.get('format') == RESOLUTION_FORMAT:
+        resolutions = saved.get('resolutions', {}).get(key, [])
+    resolutions = merge_resolution(resolutions, env, resolution)
+    write_manifest(path, {'format': RESOLUTION_FORMAT, 'resolutions': {key: resolutions}})
+
+def save_resolution(key, env, resolution):
+    _resolutions[key] = merge_resolution(_resolutions.get(key, []), env, resolution)
+    try:
+        add_resolution(resolution_cache_path(key), key, env, resolution)
+        prune_resolution_cache()
+    except (IOError, OSError):
+        # It's only a cache.
+        pass
+
+def touch_resolution_cache(path):
+    # Marks the file as recently used, for prune_resolution_cache().
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+def prune_resolution_cache(keep=MAX_RESOLUTION_FILES):
+    '''
+    Remove all but the keep most recently used files from the resolution
+    cache. Another process may be pruning it at the same time.
+    '''
+    def last_used(path):
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return 0
+    paths = glob(os.path.join(get_data_dir(), 'resolved', '*.json'))
+    paths.sort(key=last_used, reverse=True)
+    for path in paths[keep:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def write_lockfile(dependencies_filename, env, logfile=None):
+    '''
+    Resolve the dependencies file without local overrides and add the result
+    to the lockfile beside it, for builds to load without expanding anything.
+    '''
+    with open(dependencies_filename) as dependencyfile:
+        dependency_data = dependencyfile.read()
+    collection = read_json_dependencies(cStringIO.StringIO(dependency_data), cStringIO.StringIO('[]'), env, logfile)
+    resolution = collection.resolve()
+    if resolution is None:
+        raise Exception("Unable to resolve every dependency in '{0}'.".format(dependencies_filename))
+    path = lockfile_path(dependencies_filename)
+    add_resolution(path, resolution_key(dependency_data, '[]'), env, resolution)
+    return path
 
 def cli(args):
     if platform.system() != "Windows":
@@ -715,7 +3251,9 @@ def cli(args):
 
 def clean_directories(directories):
     """Remove the specified directories, trying very hard not to remove
-    anything if a failure occurs."""
+    anything if a failure occurs. The directories are moved aside at once,
+    but deleted by a background thread, which is returned. Leftovers from
+    earlier runs that didn't finish deleting are removed too."""
 
     # Some explanation is in order. Windows locks DLLs while they are in
     # use. You can't just unlink them like in Unix and create a new
@@ -734,6 +3272,9 @@ def clean_directories(directories):
     # would have failed. If one fails, we just undo the previous renames
     # and report an error. It's not bulletproof, but it should be good
     # enough for the most common scenarios.
+    # Deleting a large tree can take longer than fetching its replacement,
+    # so that part happens in the background. Each run renames to a name of
+    # its own, so that it can't collide with a deletion still in progress.
 
     try:
         directories = list(directories)
@@ -743,7 +3284,7 @@ def clean_directories(directories):
             for directory in directories:
                 if not os.path.isdir(directory):
                     continue
-                newname = directory + '.deleteme'
+                newname = '{0}.{1}-{2}{3}'.format(directory, os.getpid(), int(time.time() * 1000), DELETEME_SUFFIX)
                 lastdirectory = directory
                 os.rename(directory, newname)
                 lastdirectory = None
@@ -752,29 +3293,92 @@ def clean_directories(directories):
             for original, newname in reversed(moved):
                 os.rename(newname, original)
             raise
-        for original, newname in moved:
-            shutil.rmtree(newname)
+        stale = set()
+        for directory in directories:
+            stale.update(glob(directory + '.*' + DELETEME_SUFFIX))
+            stale.update(glob(directory + DELETEME_SUFFIX))
+        return remove_in_background(sorted(stale))
     except Exception as e:
         if lastdirectory is not None:
             raise Exception("Failed to remove directory '{0}'. Try closing applications that might be using it. (E.g. Visual Studio.)".format(lastdirectory))
         else:
             raise Exception("Failed to remove directory. Try closing applications that might be using it. (E.g. Visual Studio.)\n"+str(e))
 
+DELETEME_SUFFIX = '.deleteme'
+
+def remove_in_background(paths):
+    '''
+    Delete the directories in paths on a background thread, and return the
+    thread. It is not a daemon, so the process doesn't exit until it is
+    done. Whatever can't be deleted is left for the next clean.
+    '''
+    def remove_all():
+        for path in paths:
+            shutil.rmtree(path, ignore_errors=True)
+    thread = threading.Thread(target=remove_all, name='remove-deleteme')
+    thread.start()
+    return thread
+
 def get_data_dir():
+    # Can be moved elsewhere, e.g. to keep a scratch run away from the
+    # real cache and settings.
+    if 'OHDEVTOOLS_DATA_DIR' in os.environ:
+        return os.environ['OHDEVTOOLS_DATA_DIR']
     userdata = os.environ.get('LOCALAPPDATA', None)
     if userdata is not None:
         return userdata + '/ohDevTools'
     userdata = os.environ.get('HOME', '.')
     return userdata + '/.ohdevtools'
 
+_config = None
+_config_path = None
+
+def get_config(key, default=None):
+    '''
+    Look up a setting. The environment variable OHDEVTOOLS_<KEY> (upper
+    case, with dashes as underscores) takes precedence over the 'key'
+    entry in config.json in the data directory.
+    '''
+    global _config, _config_path
+    env_name = 'OHDEVTOOLS_' + key.upper().replace('-', '_')
+    if env_name in os.environ:
+        return os.environ[env_name]
+    config_path = get_data_dir() + '/config.json'
+    if config_path != _config_path:
+        config = {}
+        if os.path.isfile(config_path):
+            with open(config_path) as f:
+                config = json.load(f)
+        # In this order, for other threads looking it up at the same time.
+        _config = config
+        _config_path = config_path
+    return _config.get(key, default)
+
+def parse_size(value):
+    '''
+    Convert a size such as 500, '750K', '200M' or '4G' to a number of bytes.
+    '''
+    if isinstance(value, (int, long)):
+        return value
+    value = value.strip().upper()
+    multiplier = 1
+    for suffix, suffix_multiplier in [('K', 1024), ('M', 1024**2), ('G', 1024**3)]:
+        if value.endswith(suffix):
+            value = value[:-1]
+            multiplier = suffix_multiplier
+    return int(float(value) * multiplier)
+
+DEFAULT_CACHE_SIZE = '2G'
+
+def make_default_cache():
+    cache_dir = get_data_dir() + '/cache'
+    return FileCache(cache_dir, parse_size(get_config('cache-size', DEFAULT_CACHE_SIZE)))
+
 def make_default_fetcher():
-    data_dir = get_data_dir()
-    cache_dir = data_dir + '/cache'
-    cache = FileCache(cache_dir, 20)
-    return FileFetcher(cache)
+    return FileFetcher(make_default_cache(), get_config('upstream-cache'), MirrorStats(get_data_dir() + '/mirrors.json'))
 
 
-def fetch_dependencies(dependency_names=None, platform=None, env=None, fetch=True, nuget=True, clean=True, source=False, logfile=None, list_details=False, local_overrides=True, verbose=False):
+def fetch_dependencies(dependency_names=None, platform=None, env=None, fetch=True, nuget=True, clean=True, source=False, logfile=None, list_details=False, local_overrides=True, verbose=False, jobs=1, force=False, lock=False, report=None):
     '''
     Fetch all the dependencies defined in projectdata/dependencies.json and in
     projectdata/packages.config.
@@ -788,10 +3392,25 @@ def fetch_dependencies(dependency_names=None, platform=None, env=None, fetch=Tru
         True to fetch nuget packages listed in packages.config, False to skip.
     clean:
         True to clean out directories before fetching, False to skip.
+        Directories with manifests from an earlier fetch are cleaned
+        incrementally: only dependencies no longer listed are removed.
     source:
         True to fetch source for the listed dependencies, False to skip.
     logfile:
         File-like object for log messages.
+    jobs:
+        Maximum number of dependencies to download and unpack, or source
+        repos to check out, at once.
+    force:
+        True to fetch dependencies that are already up to date, and to
+        clean out directories completely.
+    lock:
+        True to write the resolved dependencies to the lockfile,
+        projectdata/dependencies.lock.json, for builds to use.
+    report:
+        Path to write a JSON report of the fetch to, with the URL, bytes
+        downloaded, timings, file count and cache outcome of each
+        dependency.
     '''
     if env is None:
         env = {}
@@ -804,21 +3423,33 @@ def fetch_dependencies(dependency_names=None, platform=None, env=None, fetch=Tru
 
     if platform is None:
         raise Exception('Platform not specified and unable to guess.')
+    incremental_dirs = []
     if clean and not list_details:
         clean_dirs = []
         if fetch:
-            clean_dirs += [
+            fetch_dirs = [
                 'dependencies/AnyPlatform',
                 'dependencies/'+platform]
+            if not force:
+                # Only files that manifests list are removed when updating
+                # in place, so anything else means starting afresh.
+                incremental_dirs = [d for d in fetch_dirs if has_manifests(d) and not untracked_files(d)]
+            clean_dirs += [d for d in fetch_dirs if d not in incremental_dirs]
         if nuget:
             clean_dirs += ['dependencies/nuget']
         clean_directories(clean_dirs)
 
 
+    if lock:
+        lockfile = write_lockfile('projectdata/dependencies.json', env, logfile)
+        default_log(logfile).write("Wrote resolved dependencies to '%s'\n" % lockfile)
     overrides_filename = '../dependency_overrides.json' if local_overrides else None
-    dependencies = read_json_dependencies_from_filename('projectdata/dependencies.json', overrides_filename, env=env, logfile=logfile)
+    # Only fetching doesn't need any keys beyond those in a resolution.
+    resolved = not source and not verbose
+    dependencies = read_json_dependencies_from_filename('projectdata/dependencies.json', overrides_filename, env=env, logfile=logfile, resolved=resolved, names=dependency_names or None)
     if list_details:
-        for name, dependency in dependencies.items():
+        for dependency in dependencies._filter(dependency_names or None):
+            name = dependency.name
             print "Dependency '{0}':".format(name)
             print "    fetches from:     {0!r}".format(dependency['archive-path'])
             print "    unpacks to:       {0!r}".format(dependency['dest'])
@@ -830,7 +3461,12 @@ def fetch_dependencies(dependency_names=None, platform=None, env=None, fetch=Tru
             print ""
     else:
         if fetch:
-            dependencies.fetch(dependency_names)
+            dependencies.remove_stale(incremental_dirs, dependency_names)
+            dependencies.fetch(dependency_names, jobs=jobs, force=force)
+            if report is not None:
+                write_fetch_report(report, dependencies.report)
+            if dependencies.store is not None:
+                dependencies.store.collect_garbage()
         if nuget:
             if not os.path.exists('projectdata/packages.config'):
                 print "Skipping NuGet invocation because projectdata/packages.config not found."
@@ -844,7 +3480,7 @@ def fetch_dependencies(dependency_names=None, platform=None, env=None, fetch=Tru
                     print "    " + nuget_exe
                 cli([nuget_exe, 'install', 'projectdata/packages.config', '-OutputDirectory', 'dependencies/nuget'])
         if source:
-            dependencies.checkout(dependency_names)
+            dependencies.checkout(dependency_names, jobs=jobs)
     return dependencies
 
 
@@ -59,3 +59,83 @@ def userlock(name):
     if platform.system() == 'Windows':
         return WindowsUserLock(name)
     return PosixUserLock(name)
+
+class FileLock(object):
+    '''
+    An exclusive lock held on an open file, which excludes other threads
+    as well as other processes. The file is created if need be, and left
+    in place afterwards unless it is released with remove set. Use acquire
+    and release, or use it as a context manager.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.f = None
+    def acquire(self, blocking=True):
+        '''
+        Take the lock, waiting for it if blocking is true. Returns whether
+        the lock was taken.
+        '''
+        while True:
+            f = open(self.filename, "a+b")
+            if not self._lock(f, blocking):
+                f.close()
+                return False
+            if self._is_current(f):
+                self.f = f
+                return True
+            # The holder before us removed the file, so whoever opens it
+            # now gets a new one. Lock that instead.
+            f.close()
+    def _is_current(self, f):
+        if platform.system() == 'Windows':
+            # Open files can't be deleted.
+            return True
+        try:
+            return os.fstat(f.fileno()).st_ino == os.stat(self.filename).st_ino
+        except OSError:
+            return False
+    def _lock(self, f, blocking):
+        if platform.system() == 'Windows':
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                    return True
+                except IOError:
+                    if not blocking:
+                        return False
+                    time.sleep(0.1)
+        import fcntl
+        try:
+            # flock, unlike lockf, also excludes other threads of this process.
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            return True
+        except IOError:
+            return False
+    def release(self, remove=False):
+        '''
+        Release the lock. If remove is true, the file is deleted too, or
+        on Windows, only if nobody else has it open.
+        '''
+        windows = platform.system() == 'Windows'
+        if remove and not windows:
+            # Waiters will find it gone once they get it, and try again.
+            os.remove(self.filename)
+        if windows:
+            import msvcrt
+            self.f.seek(0)
+            msvcrt.locking(self.f.fileno(), msvcrt.LK_UNLCK, 1)
+        self.f.close()
+        self.f = None
+        if remove and windows:
+            try:
+                os.remove(self.filename)
+            except OSError:
+                # Someone else has it open.
+                pass
+    def __enter__(self):
+        self.acquire()
+        return self
+    def __exit__(self, etype, einstance, etraceback):
+        self.release()